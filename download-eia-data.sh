@@ -1,6 +1,6 @@
 # Downloads the EIA data and puts it in $DIR.
-# Extracts the first sheet of each xlsx as a csv.
-# Needs wget, xlsx2csv
+# Extracts the first sheet of each xlsx into the simulator's cache.
+# Needs wget, python3 and numpy
 
 DIR='eia-data'
 
@@ -105,9 +105,5 @@ echo "$FILES" |
     sed 's:^.*http:http:' |
     wget -i - -nd -N -w 2 -P $DIR
 
-for i in $DIR/*.xlsx
-do
-    OFILE=`echo "$i" | sed 's:xlsx$:csv:'`
-    echo "Extracting $OFILE" # xlsx2csv is so slow...
-    xlsx2csv -d '|' -i -p "" -s 1 -f '%Y-%m-%d %H:%M:%S' $i $OFILE
-done
+# Workbooks are extracted in parallel, and unchanged ones are skipped.
+python3 "`dirname "$0"`/tsla-grid-sim.py" --extract
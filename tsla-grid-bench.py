@@ -0,0 +1,344 @@
+# Benchmarks for tsla-grid-sim.py, on synthetic data (so they don't need the EIA download).
+# Times each stage of the pipeline, records its peak memory, and compares against a saved
+# baseline:
+#
+#   python3 tsla-grid-bench.py --save       # record a baseline (before a change)
+#   python3 tsla-grid-bench.py              # compare against it (after)
+#   python3 tsla-grid-bench.py --years 10 --regions 12 --slots-per-hour 12
+#   python3 tsla-grid-bench.py --kernels --years 10 --slots-per-hour 12   # just the rolling stats
+#
+# Exits with status 1 if any stage got more than BENCH_TOLERANCE slower.
+import argparse, contextlib, importlib.util, io, json, os, sys, time, tracemalloc
+import numpy as np
+
+sim_spec = importlib.util.spec_from_file_location('tsla_grid_sim', f'{os.path.dirname(os.path.abspath(__file__))}/tsla-grid-sim.py')
+sim = importlib.util.module_from_spec(sim_spec)
+sim_spec.loader.exec_module(sim)
+
+# Synthetic data files are written here (once - they're deterministic).
+BENCH_DATA_DIR = 'bench-data'
+BENCH_BASELINE = 'bench-baseline.json'
+
+# Timings are the best of this many runs.
+BENCH_REPEATS = 3
+
+# A stage has regressed if it is this much slower than the baseline (timings are noisy), and
+# by more than BENCH_NOISE_SECONDS.
+BENCH_TOLERANCE = 0.25
+BENCH_NOISE_SECONDS = 0.02
+
+# What we benchmark by default: (style, years, regions, slots per hour).  The style is 'eia'
+# or 'gridwatch' (files in that format), or 'arrays' (in-memory data, so there's no parsing).
+# The simulation stages need at least 2 years of data.
+BENCH_CONFIGS = [
+    ('eia', 4, 4, 1),
+    ('gridwatch', 2, 1, 12),
+    ('arrays', 10, 12, 1),
+]
+
+EIA_HEADER = 'BA|Timestamp (Hour Ending)|Local time|UTC time|D|DF|NG|TI|NG: COL|NG: NG|NG: NUC|NG: OIL|NG: WAT|NG: SUN|NG: WND|NG: UNK|NG: OTH'
+GRIDWATCH_FIELDS = ['demand', 'frequency', 'coal', 'nuclear', 'ccgt', 'wind', 'pumped', 'hydro', 'biomass', 'oil',
+                    'solar', 'ocgt'] + sim.gridwatch_interconnects
+
+def synthetic_series(slots, slots_per_hour, scale, seed):
+    '''Returns a dict of deterministic (for the seed) fake generation data, in MW: demand with
+    daily and yearly cycles, gusty wind, daytime solar, flat nuclear, seasonal hydro, imports,
+    and coal and gas making up the difference.  Wind and solar ramp up over the first few
+    months, like newly built capacity.'''
+    rng = np.random.default_rng(seed)
+    hours = np.arange(slots) / slots_per_hour
+    demand = scale * (1 + 0.2 * np.sin(2 * np.pi * hours / 24) + 0.15 * np.cos(2 * np.pi * hours / sim.HOURS_PER_YEAR)
+                      + 0.05 * rng.standard_normal(slots))
+    gust_len = 200 * slots_per_hour
+    gusts = np.convolve(rng.standard_normal(slots + gust_len), np.ones(gust_len) / np.sqrt(gust_len) / 1.4, 'valid')[:slots]
+    wind = scale * 0.1 * np.maximum(gusts + 1, 0) * np.minimum(1, (hours + 1) / (24 * 200))
+    solar = (scale * 0.08 * np.maximum(np.sin(2 * np.pi * (hours % 24) / 24 - np.pi / 2), 0)
+             * (0.7 + 0.3 * rng.random(slots)) * np.minimum(1, (hours + 1) / (24 * 100)))
+    nuclear = np.full(slots, scale * 0.2)
+    hydro = scale * 0.07 * (1 + 0.3 * np.sin(2 * np.pi * hours / sim.HOURS_PER_YEAR))
+    imports = scale * 0.05 * rng.standard_normal(slots)
+    coal = scale * 0.1 * rng.random(slots)
+    gas = demand - wind - solar - nuclear - hydro - coal - imports
+    return {'D': demand, 'TI': -imports, 'NG': demand - imports, 'NG: COL': coal, 'NG: NG': gas, 'NG: NUC': nuclear, 'NG: OIL': np.zeros(slots),
+            'NG: WAT': hydro, 'NG: SUN': solar, 'NG: WND': wind, 'NG: UNK': np.zeros(slots), 'NG: OTH': np.zeros(slots)}
+
+def synthetic_timestamps(slots, slots_per_hour, offset_hours=0):
+    start = np.datetime64('2018-07-01T05:00:00') + np.timedelta64(offset_hours, 'h')
+    return start + (np.arange(slots) * (3600 // slots_per_hour)).astype('timedelta64[s]')
+
+def synthetic_data(years, slots_per_hour, seed=0):
+    '''In-memory (timestamps, data) in eia_cols order, like the loaders return.  Like the files,
+    different seeds start a few hours apart.'''
+    slots = years * sim.HOURS_PER_YEAR * slots_per_hour
+    cols = synthetic_series(slots, slots_per_hour, 1000 * (seed + 1), seed)
+    return synthetic_timestamps(slots, slots_per_hour, seed % 3), np.array([cols[c] for c in sim.eia_cols])
+
+def write_rows(fname, header, fmt, columns):
+    with open(f'{fname}.tmp', 'w') as f:
+        f.write(header + '\n')
+        f.writelines(fmt % row for row in zip(*columns))
+    os.replace(f'{fname}.tmp', fname)
+
+def write_eia_csv(fname, name, timestamps, cols):
+    '''Writes an EIA-style (pipe-delimited) CSV, with some empty fields, like the real ones'''
+    stamps = sim.format_timestamps(timestamps).tolist()
+    wind = [f'{w:.1f}' if i % 101 else '' for i, w in enumerate(cols['NG: WND'].tolist())]
+    write_rows(fname, EIA_HEADER, f'{name}|x|%s|%s|%.1f|%.0f|%.1f|%.1f|%.1f|%.1f|%.1f||%.1f|%.1f|%s|%.1f|0\n',
+               [stamps, stamps, cols['D'], cols['D'], cols['NG'], cols['TI'], cols['NG: COL'], cols['NG: NG'],
+                cols['NG: NUC'], cols['NG: WAT'], cols['NG: SUN'], wind, cols['NG: UNK']])
+
+def write_gridwatch_csv(fname, timestamps, cols):
+    '''Writes a GridWatch-style (comma-delimited) CSV, with jittered timestamps and the -6e34
+    interconnect glitch'''
+    slots = len(timestamps)
+    jitter = np.random.default_rng(len(timestamps)).integers(0, 20, slots).astype('timedelta64[s]')
+    stamps = sim.format_timestamps(timestamps + jitter).tolist()
+    solar = cols['NG: SUN']
+    gas, hydro = cols['NG: NG'], cols['NG: WAT']
+    fields = {'demand': cols['D'] - solar, 'frequency': np.full(slots, 50.0), 'coal': cols['NG: COL'],
+              'nuclear': cols['NG: NUC'], 'ccgt': gas * 0.9, 'wind': cols['NG: WND'], 'pumped': hydro * 0.3,
+              'hydro': hydro * 0.7, 'biomass': np.full(slots, 10.0), 'oil': cols['NG: OIL'], 'solar': solar,
+              'ocgt': gas * 0.1}
+    for ic in sim.gridwatch_interconnects:
+        fields[ic] = -cols['TI'] / len(sim.gridwatch_interconnects)
+    fields['french_ict'] = fields['french_ict'].copy()
+    fields['french_ict'][slots // 3] = -6e34
+    write_rows(fname, 'id, timestamp, ' + ', '.join(GRIDWATCH_FIELDS), '%d, %s' + ', %.0f' * len(GRIDWATCH_FIELDS) + '\n',
+               [range(slots), stamps] + [fields[f] for f in GRIDWATCH_FIELDS])
+
+def synthetic_files(style, years, regions, slots_per_hour):
+    '''Writes the synthetic data files for a benchmark config (unless they're already there),
+    returning their names.  EIA regions start a few hours apart, so they need aligning.'''
+    dir = f'{BENCH_DATA_DIR}/{style}-{years}y-{regions}r-{slots_per_hour}sph'
+    os.makedirs(dir, exist_ok=True)
+    slots = years * sim.HOURS_PER_YEAR * slots_per_hour
+    fnames = []
+    for r in range(regions):
+        fname = f'{dir}/{"gridwatch" if style == "gridwatch" else f"Region_R{r:02}"}.csv'
+        if not os.path.exists(fname):
+            cols = synthetic_series(slots, slots_per_hour, (30000 if style == 'gridwatch' else 1000) * (r + 1), r)
+            timestamps = synthetic_timestamps(slots, slots_per_hour, r % 3)
+            if style == 'gridwatch':
+                write_gridwatch_csv(fname, timestamps, cols)
+            else:
+                write_eia_csv(fname, f'R{r:02}', timestamps, cols)
+        fnames.append(fname)
+    return fnames
+
+def quietly(fun):
+    '''Returns fun(), throwing away anything it prints'''
+    with contextlib.redirect_stdout(io.StringIO()):
+        return fun()
+
+def measure(fun, repeats=BENCH_REPEATS):
+    '''Returns (fun(), best time in seconds, peak memory in MB).  The memory is measured in a
+    separate run, as tracing slows things down.'''
+    best = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = fun()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    tracemalloc.start()
+    try:
+        fun()
+        peak = tracemalloc.get_traced_memory()[1] / 1e6
+    finally:
+        tracemalloc.stop()
+    return result, best, peak
+
+def run_config(style, years, regions, slots_per_hour, repeats=BENCH_REPEATS):
+    '''Runs the pipeline stages on a config's synthetic data.  Returns {stage: (seconds, peak MB)}.'''
+    results = {}
+    def stage(name, fun):
+        result, seconds, peak = measure(fun, repeats)
+        results[name] = (seconds, peak)
+        return result
+
+    if style == 'arrays':
+        csvs = [synthetic_data(years, slots_per_hour, r) + (f'R{r:02}',) for r in range(regions)]
+    else:
+        fnames = synthetic_files(style, years, regions, slots_per_hour)
+        cache_dir, sim.CACHE_DIR = sim.CACHE_DIR, None # time the parsing, not the cache
+        try:
+            if style == 'gridwatch':
+                csvs = stage('parse', lambda: [sim.stream_load(fn, sim.gridwatch_cols, sim.gridwatch_timestamp, delimiter=',',
+                                                               spike_limit=sim.GRIDWATCH_SPIKE_LIMIT) + (fn,) for fn in fnames])
+            else:
+                csvs = stage('parse', lambda: [sim.load_csv(fn, sim.eia_cols, sim.eia_timestamp) + (fn,) for fn in fnames])
+        finally:
+            sim.CACHE_DIR = cache_dir
+    aligned, timestamps = stage('align', lambda: sim.align_csv_dates(csvs))
+    data = stage('combine', lambda: sim.combine_aligned_csvs(aligned))
+
+    params = sim.SimParams(f'{style} (synthetic)')
+    wind, solar = sim.series(data, sim.WIND_COL), sim.series(data, sim.SOLAR_COL)
+    stage('filter', lambda: sim.adequate_generation(wind, solar, params, slots_per_hour))
+    cpfun = stage('prepare', lambda: quietly(lambda: sim.simulate(data, params, slots_per_hour, timestamps, quiet=True)))
+    if cpfun is None:
+        print(f'{config_name(style, years, regions, slots_per_hour)}: not enough data to simulate')
+        return results
+    # As simulate() does it (on hourly sums, for sub-hourly data).
+    block_slots = sim.coarse_slots(params, slots_per_hour)
+    if block_slots > 1:
+        walk_terms = cpfun.walk_terms()
+        wind_frac, _ = stage('optimise', lambda: sim.drawdown_solver(sim.coarse_walk_terms(walk_terms, block_slots), slots_per_hour)
+                             .best_wind_fraction(params.overbuild))
+    else:
+        wind_frac = stage('optimise', lambda: sim.optimise_wind_frac(cpfun, params.overbuild))
+    cum_storage = cpfun(wind_frac, params.overbuild)[3]
+    def drawdowns():
+        max_drawdown, _, _ = sim.get_max_drawdown(cum_storage)
+        sim.get_drawdowns(cum_storage, max_drawdown / 2)
+        sim.enumerate_drawdowns(cum_storage, params.storage_hours * slots_per_hour)
+    stage('drawdowns', drawdowns)
+    stage('report', lambda: quietly(lambda: sim.simulate(data, params, slots_per_hour, timestamps)))
+    return results
+
+# The rolling statistics as they were (from one cumulative sum over the whole series, and a
+# gather for the lookahead), to compare the kernels against.
+
+def cumsum_centered_sma(vec, lookahead, season_len=None):
+    if not season_len:
+        season_len = lookahead
+    icols = lookahead // 2
+    fcols = lookahead - icols
+    cs = np.cumsum(vec, dtype=float)
+    cs[icols:-fcols] = (cs[lookahead:] - cs[:-lookahead]) / lookahead
+    cs[:icols] = cs[season_len:season_len + icols]
+    cs[-fcols:] = cs[-fcols-season_len:-season_len]
+    return cs
+
+def cumsum_trailing_sma(vec, window):
+    cs = np.cumsum(vec)
+    cs[window:] = (cs[window:] - cs[:-window]) / window
+    cs[:window] /= np.arange(1, window+1)
+    return cs
+
+def gather_lookahead_max(vec, lookahead):
+    running_max = np.maximum.accumulate(vec, axis=-1)
+    slots = vec.shape[-1]
+    if not lookahead or lookahead >= slots:
+        return running_max
+    return running_max[..., np.minimum(np.arange(slots) + lookahead, slots - 1)]
+
+def exact_window_means(vec, window):
+    '''The mean of each `window` consecutive values, to extended precision'''
+    cs = np.cumsum(vec, axis=-1, dtype=np.longdouble)
+    return np.concatenate((cs[..., window - 1:window], cs[..., window:] - cs[..., :-window]), axis=-1) / window
+
+def check_short_sma(vec, window):
+    '''Checks centered_sma(vec, window, window) on a series shorter than two windows (as
+    simulate() levelises 1.5 to 2 years of slots): the ends must come from the window means it
+    worked out, and so be the same from call to call whatever was in memory before.  Returns
+    whether it passed.'''
+    results = []
+    for garbage in (np.nan, 1e300):
+        np.full(vec.shape, garbage) # leave garbage where the next allocation may go
+        results.append(sim.centered_sma(vec, window, window))
+    means = np.unique(results[0][window // 2:-(window - window // 2)])
+    ok = (np.array_equal(results[0], results[1]) and np.isfinite(results[0]).all()
+          and np.isin(results[0], means).all())
+    print(f'    Short series ({len(vec)} slots, window {window}): {"OK" if ok else "FAILED"}')
+    return ok
+
+def run_kernels(years, regions, slots_per_hour, repeats=BENCH_REPEATS):
+    '''Times the rolling statistics against the versions they replaced, on the synthetic wind
+    and solar (and demand, for the yearly averages) of `regions` regions, one row at a time and
+    as a batch, in float64 and float32.  Prints the times and the largest error in the window
+    means (against extended precision), and returns whether check_short_sma() passed.'''
+    slots = years * sim.HOURS_PER_YEAR * slots_per_hour
+    params = sim.SimParams('kernels (synthetic)')
+    filter_window = params.cf_filter_duration * slots_per_hour
+    year_slots = sim.HOURS_PER_YEAR * slots_per_hour
+    lookahead = params.capacity_planning_lookahead * slots_per_hour
+    cols = [synthetic_series(slots, slots_per_hour, 1000 * (r + 1), r) for r in range(regions)]
+    renewables = np.array([c[k] for c in cols for k in ('NG: WND', 'NG: SUN')])
+    demand = np.array([c['D'] for c in cols])
+    print(f'Rolling statistics: {2 * regions} rows of {slots} slots')
+    print('    Kernel        dtype   Old s   New s  Batch s   Old error   New error')
+    cases = [('centered_sma', renewables, filter_window, cumsum_centered_sma, sim.centered_sma),
+             ('yearly_sma', demand, year_slots, lambda v, w: cumsum_centered_sma(v, w, w), lambda v, w: sim.centered_sma(v, w, w)),
+             ('trailing_sma', renewables, filter_window, cumsum_trailing_sma, sim.trailing_sma),
+             ('lookahead_max', renewables, lookahead, gather_lookahead_max, sim.lookahead_max)]
+    for name, rows, window, old, new in cases:
+        for dtype in (np.float64, np.float32):
+            rows = rows.astype(dtype)
+            _, old_seconds, _ = measure(lambda: [old(r, window) for r in rows], repeats)
+            new_rows, new_seconds, _ = measure(lambda: [new(r, window) for r in rows], repeats)
+            _, batch_seconds, _ = measure(lambda: new(rows, window), repeats)
+            errors = ''
+            if name != 'lookahead_max':
+                exact = exact_window_means(rows, window)
+                # Just the full windows (the ends are filled in from elsewhere).  The centered
+                # averages start with the window from slot 1.
+                if name == 'trailing_sma':
+                    full = slice(window - 1, None)
+                else:
+                    full, exact = slice(window // 2, slots - (window - window // 2)), exact[:, 1:]
+                old_error = max(np.abs(old(r, window)[full] - e).max() for r, e in zip(rows, exact))
+                new_error = max(np.abs(n[full] - e).max() for n, e in zip(new_rows, exact))
+                errors = f' {old_error:11.3g} {new_error:11.3g}'
+            print(f'    {name:13} {np.dtype(dtype).name:7} {old_seconds:7.3f} {new_seconds:7.3f} {batch_seconds:8.3f}{errors}')
+    return check_short_sma(demand[0, :year_slots * 7 // 4], year_slots)
+
+def config_name(style, years, regions, slots_per_hour):
+    return f'{style}-{years}y-{regions}r-{slots_per_hour}sph'
+
+def compare(name, results, baseline, tolerance=BENCH_TOLERANCE):
+    '''Prints a config's results against the baseline.  Returns the stages that regressed.'''
+    print(f'{name}:')
+    print('    Stage        Seconds  Baseline  Change %   Peak MB  Baseline')
+    regressed = []
+    for stage, (seconds, peak) in results.items():
+        base_seconds, base_peak = baseline.get(stage, (None, None))
+        if base_seconds:
+            change = (seconds - base_seconds) / base_seconds
+            flag = '  SLOWER' if change > tolerance and seconds - base_seconds > BENCH_NOISE_SECONDS else ''
+            if flag:
+                regressed.append(f'{name}: {stage}')
+            print(f'    {stage:10} {seconds:9.3f} {base_seconds:9.3f} {100 * change:9.1f} {peak:9.1f} {base_peak:9.1f}{flag}')
+        else:
+            print(f'    {stage:10} {seconds:9.3f} {"-":>9} {"-":>9} {peak:9.1f} {"-":>9}')
+    return regressed
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark tsla-grid-sim.py on synthetic data')
+    parser.add_argument('--style', choices=['eia', 'gridwatch', 'arrays'], default='eia')
+    parser.add_argument('--years', type=int, help='years of data (1-10); without this, run BENCH_CONFIGS')
+    parser.add_argument('--regions', type=int, default=1, help='how many region files to align and combine')
+    parser.add_argument('--slots-per-hour', type=int, default=1, help='1 for hourly data, 12 for 5-minute')
+    parser.add_argument('--repeats', type=int, default=BENCH_REPEATS)
+    parser.add_argument('--save', action='store_true', help=f'save the results as the baseline ({BENCH_BASELINE})')
+    parser.add_argument('--kernels', action='store_true', help='compare the rolling statistics with the old versions instead')
+    args = parser.parse_args()
+
+    if args.kernels:
+        if not run_kernels(args.years or 4, args.regions, args.slots_per_hour, args.repeats):
+            sys.exit(1)
+        return
+
+    configs = BENCH_CONFIGS
+    if args.years:
+        configs = [(args.style, args.years, args.regions, args.slots_per_hour)]
+    baseline = {}
+    if os.path.exists(BENCH_BASELINE):
+        with open(BENCH_BASELINE) as f:
+            baseline = json.load(f)
+    regressed = []
+    for config in configs:
+        name = config_name(*config)
+        results = run_config(*config, repeats=args.repeats)
+        regressed += compare(name, results, {} if args.save else baseline.get(name, {}))
+        baseline[name] = results
+    if args.save:
+        with open(f'{BENCH_BASELINE}.tmp', 'w') as f:
+            json.dump(baseline, f, indent=1)
+        os.replace(f'{BENCH_BASELINE}.tmp', BENCH_BASELINE)
+        print(f'Saved baseline: {BENCH_BASELINE}')
+    elif regressed:
+        print(f'Slower than the baseline: {"; ".join(regressed)}')
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
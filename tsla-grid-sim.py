@@ -1,11 +1,20 @@
 # A sanity check on Tesla's energy generation numbers.  See tsla-grid.md.
 # This started as a quick hack, then grew.  Don't expect quality code.
-import csv, os, graphlib
+import asyncio, contextlib, copy, csv, functools, io, os, re, signal, socket, sys, time, hashlib, itertools, json, multiprocessing, zipfile
+from multiprocessing import shared_memory
+import xml.etree.ElementTree as ET
 import numpy as np
 
 EIA_DATA_DIR = 'eia-data'
 
-# The big US regions
+# Parsed data is cached here (as memory-mappable .npy files), so reruns don't have to
+# parse the CSVs again.  Entries are rebuilt automatically when a source file changes.
+# Set to None to disable caching.
+CACHE_DIR = 'cache'
+
+# The big US regions.  Components are EIA regions (the Region_ files), balancing authorities
+# (the BA files, downloaded with download-eia-data.sh -a) or other regions defined here.  Each
+# region is summed once (and cached), and reused by the regions made from it.
 EIA_REGIONS = {
     'Western': ['NW', 'CAL', 'SW'],
     'Central': ['CENT', 'MIDW'],
@@ -13,8 +22,9 @@ EIA_REGIONS = {
     'Eastern': ['NE', 'NY', 'MIDA', 'TEN', 'SE', 'FLA', 'CAR'],
     'Lower48': ['US48']
 }
-EIA_REGIONS['CentralAndEastern'] = EIA_REGIONS['Central'] + EIA_REGIONS['Eastern']
-EIA_REGIONS['All'] = EIA_REGIONS['CentralAndEastern'] + EIA_REGIONS['Texas'] + EIA_REGIONS['Western'] # should match US48
+EIA_REGIONS['CentralAndEastern'] = ['Central', 'Eastern']
+EIA_REGIONS['All'] = ['CentralAndEastern', 'Texas', 'Western'] # should match US48
+# EIA_REGIONS['PacificNorthwest'] = ['BPAT', 'PACW', 'PGE', 'PSEI', 'SCL', 'TPWR']
 
 HOURS_PER_YEAR = 24 * 365
 
@@ -38,6 +48,81 @@ TSLA_WIND_PERCENTAGE = 0.4
 # hours of levelised demand drawdown before blackouts happen
 TSLA_STORAGE_HOURS = 120 / 11637 * HOURS_PER_YEAR
 
+# Set to a filename to log the time spent in each stage (of loading, aligning and simulating)
+# there, as JSON lines: {"span", "parent", "call" (how many times the span has run), "seconds",
+# "bytes" (of the arrays it returned), "pid", ...}.  Costs next to nothing when it's None.
+TRACE_FILE = None
+
+# The trace file (opened by the first span to finish in each process), and the spans running.
+trace_out = [None, None]
+trace_stack = []
+trace_calls = {}
+
+class Span(object):
+    '''A named, timed stage, which is traced when it finishes.  Use record() to add fields,
+    and allocated() to count the bytes of the arrays it makes.'''
+    def __init__(self, name, fields):
+        self.name = name
+        self.fields = fields
+
+    def __enter__(self):
+        self.parent = trace_stack[-1].name if trace_stack else None
+        trace_stack.append(self)
+        self.start = time.time()
+        self.clock = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        seconds = time.perf_counter() - self.clock
+        trace_stack.pop()
+        trace_calls[self.name] = trace_calls.get(self.name, 0) + 1
+        write_trace(dict({'span': self.name, 'parent': self.parent, 'call': trace_calls[self.name],
+                          'start': self.start, 'seconds': seconds, 'pid': os.getpid()}, **self.fields))
+
+    def record(self, **fields):
+        self.fields.update(fields)
+
+    def allocated(self, *arrays):
+        self.fields['bytes'] = self.fields.get('bytes', 0) + sum(a.nbytes for a in arrays if isinstance(a, np.ndarray))
+
+class NoSpan(object):
+    '''What span() returns when tracing is off'''
+    def __enter__(self):
+        return self
+    def __exit__(self, *exc):
+        pass
+    def record(self, **fields):
+        pass
+    def allocated(self, *arrays):
+        pass
+
+NO_SPAN = NoSpan()
+
+def span(name, **fields):
+    '''with span('stage'): ... traces the stage (if TRACE_FILE is set)'''
+    return Span(name, fields) if TRACE_FILE else NO_SPAN
+
+def write_trace(record):
+    # Worker processes open their own file (it's opened for appending, so lines don't clobber each other).
+    if trace_out[0] != (os.getpid(), TRACE_FILE):
+        trace_out[:] = [(os.getpid(), TRACE_FILE), open(TRACE_FILE, 'a', buffering=1)]
+    trace_out[1].write(json.dumps(record, default=str) + '\n')
+
+def traced(name, describe=None):
+    '''Decorates a function to run it in a span (if TRACE_FILE is set), counting the bytes of
+    the arrays it returns.  describe(*args, **kwargs) can return extra fields for the trace.'''
+    def decorate(fun):
+        @functools.wraps(fun)
+        def traced_fun(*args, **kwargs):
+            if not TRACE_FILE:
+                return fun(*args, **kwargs)
+            with Span(name, describe(*args, **kwargs) if describe else {}) as s:
+                result = fun(*args, **kwargs)
+                s.allocated(*(result if isinstance(result, tuple) else (result,)))
+                return result
+        return traced_fun
+    return decorate
+
 class ParameterBase(object):
     def __init__(self, overrides=None):
         for k, v in self.parameter_defaults().items():
@@ -79,6 +164,8 @@ class SimParams(ParameterBase):
             # 'cf_filter_duration': 24 * 7 * 16,
             # 'min_historical_cf': 0, # don't filter any historical low-renewables ranges (useful for GridWatch)
             # 'storage_hours': 10,
+            # 'storage_efficiency': 0.85,
+            # 'storage_discharge_power': 2,
             # 'isolate_region': True,
             # 'capacity_planning_lookahead': 0, # No lookahead
             # 'capacity_planning_lookahead': HOURS_PER_YEAR // 4, # 3 months
@@ -89,6 +176,7 @@ class SimParams(ParameterBase):
             # 'solar_dcf': TSLA_SOLAR_DCF,
             # 'optimise_wind_fraction': False,
             # 'default_wind_fraction': 0.75,
+            # 'coarse_optimise_hours': None, # optimise at full resolution
 
             ## Eliminate nuclear and hydro as well:
             # 'keep_generators': [],
@@ -113,6 +201,11 @@ class SimParams(ParameterBase):
 
             # How much storage we will install.  Depleting storage causes blackouts, which are tracked and summarised.
             'storage_hours': (TSLA_STORAGE_HOURS, None),
+            # The battery's round trip efficiency, and the most it can charge or discharge at once (as a
+            # multiple of the levelised renewables output).  None means there is no limit.
+            'storage_efficiency': (1, None),
+            'storage_charge_power': (None, None),
+            'storage_discharge_power': (None, None),
 
             # If true, then set the region's electricity imports/exports to zero - we must cover
             # net imports with local renewables, but no longer need to generate exports.
@@ -144,6 +237,16 @@ class SimParams(ParameterBase):
             # If optimise_wind_fraction is False, we will assume 40% wind, 60% solar.
             'optimise_wind_fraction': (True, None),
             'default_wind_fraction': (TSLA_WIND_PERCENTAGE, None),
+            # With sub-hourly data (GridWatch's 5-minute slots), the wind fraction is optimised on
+            # the walk summed over this many hours, and the storage it needs is then worked out at
+            # full resolution.  The coarse walk misses the swings within each block, so it can
+            # only understate the storage: the difference bounds how far from the minimum we are
+            # (and is reported).  None optimises at full resolution (as hourly data always is).
+            'coarse_optimise_hours': (1, None),
+
+            # Store the data series as float32 (walks are still summed as float64).  Halves the
+            # memory each simulation needs, at the cost of some precision.
+            'single_precision': (False, None),
 
             # Sets the list of generation types that should be retained.  By default we keep
             # nuclear and hydroelectric; everything else is replaced by wind and solar.
@@ -151,23 +254,284 @@ class SimParams(ParameterBase):
                                 lambda g: f'{g} - {[eia_cols[i] for i in g]}'),
         }
     
-def simulate(basedata, params, slots_per_hour, timestamps, quiet=False):
-    '''Runs generation and storage against historical data, replacing any generators
-    not listed in `params.keep_generators` with renewable resources.'''
+# Rolling statistics.  These work along the last axis, so they can do a batch of rows at once.
+# Window sums come from cumulative sums which restart every block (of the window's length), in
+# float64, so their rounding errors are those of a window's sum.  Differences of one cumulative
+# sum over the whole series have errors which grow with its length (years of 5-minute data lose
+# several digits of each average, and in float32 they'd lose the lot).
+
+def rolling_sums(vecs, window):
+    '''Returns the sum of each `window` consecutive values, vecs[..., i:i+window] for i = 0 ..
+    slots - window, in float64'''
+    vecs = np.asarray(vecs)
+    rows, slots = vecs.shape[:-1], vecs.shape[-1]
+    blocks = -(-slots // window)
+    cs = np.empty(rows + (blocks, window))
+    cs.reshape(rows + (-1,))[..., :slots] = vecs
+    cs.reshape(rows + (-1,))[..., slots:] = 0
+    np.cumsum(cs, axis=-1, out=cs)
+    # The window ending at slot e = k*window + p (k > 0) is the rest of block k - 1 plus the
+    # start of block k: cs[k, p] + cs[k-1, -1] - cs[k-1, p].  It goes in sums[k, p], so the
+    # flattened sums are indexed by the slot each window ends at.
+    sums = np.empty_like(cs)
+    np.subtract(cs[..., 1:, :], cs[..., :-1, :], out=sums[..., 1:, :])
+    sums[..., 1:, :] += cs[..., :-1, -1:]
+    sums[..., 0, -1] = cs[..., 0, -1]
+    return sums.reshape(rows + (-1,))[..., window - 1:slots]
+
+@traced('lookahead_max')
+def lookahead_max(vec, lookahead):
+    '''Returns the running maximum of a vector (or of each row of an array), looking
+    `lookahead` slots ahead'''
+    running_max = np.maximum.accumulate(vec, axis=-1)
+    slots = vec.shape[-1]
+    if lookahead and lookahead < slots:
+        # Shifted in place (it's the max up to `lookahead` slots on, or the overall max).
+        running_max[..., :-lookahead] = running_max[..., lookahead:]
+        running_max[..., -lookahead:] = running_max[..., -1:]
+    return running_max
+
+def series(basedata, row, slots=None, dtype=float):
+    '''Returns a copy of one row of the data (just the given slots, if any), with negative
+    generation clipped to 0'''
+    vec = np.array(basedata[row] if slots is None else basedata[row, slots], dtype=dtype)
+    if row >= FIRST_GEN_COL:
+        np.maximum(vec, 0, out=vec)
+    return vec
+
+def nonrenewable_supply(basedata, params, slots=None, dtype=float):
+    '''The output of the generators we're keeping, plus net imports (unless the region is
+    isolated).  We add up a row at a time, so it doesn't matter how many there are.'''
+    nonrenewables_contribution = None
+    for row in params.keep_generators:
+        if nonrenewables_contribution is None:
+            nonrenewables_contribution = series(basedata, row, slots, dtype)
+        else:
+            nonrenewables_contribution += series(basedata, row, slots, dtype)
+    if nonrenewables_contribution is None:
+        nonrenewables_contribution = np.zeros_like(series(basedata, DEMAND_COL, slots, dtype))
+    if not params.isolate_region:
+        nonrenewables_contribution -= series(basedata, EXPORT_COL, slots, dtype) # negative numbers are power imports
+    return nonrenewables_contribution
+
+@traced('required_capacity')
+def required_capacity(required_renewables, params, slots_per_hour):
+    '''Sizes the renewables (before overbuild) from the maximum and rolling average
+    renewables demand'''
     year_slots = HOURS_PER_YEAR * slots_per_hour
     lookahead_slots = params.capacity_planning_lookahead * slots_per_hour
+    levelised_required_renewables = centered_sma(required_renewables, year_slots, year_slots)
+    max_levelised_required = lookahead_max(levelised_required_renewables, lookahead_slots)
+    max_nonlevelised_required = lookahead_max(required_renewables, lookahead_slots)
+    return params.capacity_planning_percentile * max_nonlevelised_required + (1 - params.capacity_planning_percentile) * max_levelised_required
+
+def capacity_factors(data, lookahead_slots):
+    '''Returns the observed historical max power outputs, and the capacity factors relative
+    to them'''
+    historical_maxes = lookahead_max(data, lookahead_slots)
+    cap_factors = np.divide(data, historical_maxes, out=np.zeros_like(historical_maxes), where=historical_maxes!=0)
+    return historical_maxes, cap_factors
+
+def discount_factors(wind_cap_factors, solar_cap_factors, params):
+    '''The (wind, solar) discounted capacity factors we will size generation with'''
+    if not params.calculate_dcf:
+        return params.default_wind_dcf, params.default_solar_dcf
+    levelised_wind_dcf = max(np.average(wind_cap_factors), 0.001) # uncurtailed
+    levelised_solar_dcf = max(np.average(solar_cap_factors), 0.001)
+    return levelised_wind_dcf, levelised_solar_dcf
+
+def storage_walk_terms(demand, nonrenewables_contribution, max_required, wind_dcf, wind_cap_factors, solar_dcf, solar_cap_factors):
+    '''The storage generated in each slot is deficit/(1+overbuild) + wind_fraction*wind +
+    (1-wind_fraction)*solar, for the (deficit, wind, solar) terms returned here.  That lets us
+    evaluate whole grids of parameters at once.'''
+    return np.array([(nonrenewables_contribution - demand) / max_required,
+                     wind_cap_factors / wind_dcf,
+                     solar_cap_factors / solar_dcf])
+
+def walk_parameterised(walk_terms):
+    '''A cheap calc_parameterised() (see simulate()) which only calculates cum_storage'''
+    def calc_walk(wind_fraction, overbuild):
+        return None, None, None, np.cumsum(np.array([1 / (1 + overbuild), wind_fraction, 1 - wind_fraction]) @ walk_terms)
+    return calc_walk
+
+@traced('adequate_generation')
+def adequate_generation(wind, solar, params, slots_per_hour):
+    '''Which slots have enough wind and solar generation around them to estimate capacity
+    factors from (see simulate()).  Takes rows of wind and solar (one per region) too.'''
+    missing_window_len = params.cf_filter_duration * slots_per_hour
+    adequate_wind_gen = centered_sma(wind, missing_window_len) > np.maximum.accumulate(wind, axis=-1) * params.min_historical_cf
+    adequate_solar_gen = centered_sma(solar, missing_window_len) > np.maximum.accumulate(solar, axis=-1) * params.min_historical_cf
+    return adequate_wind_gen & adequate_solar_gen
+
+# simulate()'s stages.  Each takes (basedata, params, slots_per_hour, timestamps) and the outputs
+# of the stages it depends on (see SIMULATION_STAGES).
+def stage_series(basedata, params, slots_per_hour, timestamps):
+    '''The wind and solar rows (as float32, if params.single_precision)'''
+    dtype = np.float32 if params.single_precision else float
+    return series(basedata, WIND_COL, dtype=dtype), series(basedata, SOLAR_COL, dtype=dtype)
+
+def stage_filter(basedata, params, slots_per_hour, timestamps, renewables):
+    '''Which slots we have enough wind and solar generation in (see adequate_generation())'''
+    return adequate_generation(*renewables, params, slots_per_hour)
+
+def stage_kept(basedata, params, slots_per_hour, timestamps, renewables, adequate_gen):
+    '''The (demand, nonrenewables_contribution, timestamps) of the slots we keep'''
+    dtype = renewables[0].dtype
+    return (series(basedata, DEMAND_COL, adequate_gen, dtype), nonrenewable_supply(basedata, params, adequate_gen, dtype),
+            timestamps[adequate_gen])
+
+def stage_required(basedata, params, slots_per_hour, timestamps, kept):
+    '''The renewables we need to build (see required_capacity())'''
+    demand, nonrenewables_contribution, _ = kept
+    required_renewables = demand - nonrenewables_contribution
+    required_renewables[required_renewables < 0] = 0
+    return required_capacity(required_renewables, params, slots_per_hour)
+
+def stage_cap_factors(basedata, params, slots_per_hour, timestamps, renewables, adequate_gen):
+    '''The (wind, solar) capacity factors of the slots we keep, and the final (wind, solar)
+    historical maxes (see capacity_factors())'''
+    lookahead_slots = params.capacity_planning_lookahead * slots_per_hour
+    wind_maxes, wind_cap_factors = capacity_factors(renewables[0][adequate_gen], lookahead_slots)
+    solar_maxes, solar_cap_factors = capacity_factors(renewables[1][adequate_gen], lookahead_slots)
+    return wind_cap_factors, solar_cap_factors, wind_maxes[-1], solar_maxes[-1]
+
+def stage_dcf(basedata, params, slots_per_hour, timestamps, cap_factors):
+    '''The (wind, solar) discounted capacity factors (see discount_factors())'''
+    return discount_factors(cap_factors[0], cap_factors[1], params)
+
+def stage_calc(basedata, params, slots_per_hour, timestamps, kept, max_required, cap_factors, dcf):
+    '''simulate()'s calc_parameterised() (without the attributes simulate() gives it)'''
+    demand, nonrenewables_contribution, _ = kept
+    wind_cap_factors, solar_cap_factors, _, _ = cap_factors
+    wind_dcf, solar_dcf = dcf
+
+    @traced('calc_parameterised')
+    def calc_parameterised(wind_fraction, overbuild):
+        # Generation will be sized based on the maximum prior supply deficit (max_required).
+        max_overbuilt = max_required * (1 + overbuild)
+        wind_nameplate = (wind_fraction / wind_dcf) * max_overbuilt
+        solar_nameplate = ((1 - wind_fraction) / solar_dcf) * max_overbuilt
+        renewables_levelised = wind_nameplate * wind_dcf + solar_nameplate * solar_dcf # levelised annual output at each hour
+        # Power output based on historical weather (in place, to save memory)
+        storage_hours_generated = wind_nameplate * wind_cap_factors
+        storage_hours_generated += solar_nameplate * solar_cap_factors
+        storage_hours_generated += nonrenewables_contribution # generated
+        storage_hours_generated -= demand # oversupply
+        storage_hours_generated /= renewables_levelised # per hour
+        cum_storage = np.cumsum(storage_hours_generated, dtype=float)
+        return (wind_nameplate, solar_nameplate, storage_hours_generated, cum_storage)
+    return calc_parameterised
+
+def stage_walk_terms(basedata, params, slots_per_hour, timestamps, kept, max_required, cap_factors, dcf):
+    '''The storage_walk_terms()'''
+    demand, nonrenewables_contribution, _ = kept
+    return storage_walk_terms(demand, nonrenewables_contribution, max_required,
+                              dcf[0], cap_factors[0], dcf[1], cap_factors[1])
+
+def stage_coarse_walk_terms(basedata, params, slots_per_hour, timestamps, walk_terms):
+    '''The walk terms summed over blocks of params.coarse_optimise_hours (None if that's no
+    coarser than the data, in which case the walk terms aren't worked out)'''
+    block_slots = coarse_slots(params, slots_per_hour)
+    if block_slots <= 1:
+        return None
+    return coarse_walk_terms(walk_terms(), block_slots)
+
+def stage_wind_fraction(basedata, params, slots_per_hour, timestamps, calc_parameterised, coarse_terms):
+    '''The wind fraction (optimised for params.overbuild, if params.optimise_wind_fraction), and
+    the storage (storage-hours) the coarse walk needs with it (None if it wasn't used)'''
+    if not params.optimise_wind_fraction:
+        return params.default_wind_fraction, None
+    if coarse_terms is None:
+        return optimise_wind_frac(calc_parameterised, params.overbuild), None
+    return drawdown_solver(coarse_terms, slots_per_hour).best_wind_fraction(params.overbuild)
+
+def stage_contributions(basedata, params, slots_per_hour, timestamps, renewables, adequate_gen):
+    '''The historical (name, min capacity factor, average capacity factor, min contribution,
+    average contribution, max contribution) of each generator, in the slots we keep'''
+    dtype = renewables[0].dtype
+    lookahead_slots = params.capacity_planning_lookahead * slots_per_hour
+    contributions = []
+    total_gen = series(basedata, TOTAL_GEN_COL, adequate_gen, dtype)
+    for i in range(FIRST_GEN_COL, len(eia_cols)):
+        gen = series(basedata, i, adequate_gen, dtype)
+        _, cap_factors = capacity_factors(gen, lookahead_slots)
+        contrib = gen / total_gen
+        contributions.append((eia_cols[i], float(cap_factors.min()), float(np.average(cap_factors)),
+                              float(contrib.min()), float(np.average(contrib)), float(contrib.max())))
+    return contributions
+
+# The stages, as (the parameters a stage depends on, the stages it takes the outputs of, the
+# stage).  A stage also depends on the parameters of the stages it uses, so changing (say)
+# storage_hours or overbuild doesn't redo the filtering, the averages or the maxima.  A stage
+# named with () (like 'walk_terms()') is passed as a function which gets its output, so it's
+# only worked out if the stage asks for it.
+SIMULATION_STAGES = {
+    'renewables':    (['single_precision'], [], stage_series),
+    'adequate_gen':  (['cf_filter_duration', 'min_historical_cf'], ['renewables'], stage_filter),
+    'kept':          (['keep_generators', 'isolate_region'], ['renewables', 'adequate_gen'], stage_kept),
+    'max_required':  (['capacity_planning_lookahead', 'capacity_planning_percentile'], ['kept'], stage_required),
+    'cap_factors':   (['capacity_planning_lookahead'], ['renewables', 'adequate_gen'], stage_cap_factors),
+    'dcf':           (['calculate_dcf', 'default_wind_dcf', 'default_solar_dcf'], ['cap_factors'], stage_dcf),
+    'calc':          ([], ['kept', 'max_required', 'cap_factors', 'dcf'], stage_calc),
+    'walk_terms':    ([], ['kept', 'max_required', 'cap_factors', 'dcf'], stage_walk_terms),
+    'coarse_walk_terms': (['coarse_optimise_hours'], ['walk_terms()'], stage_coarse_walk_terms),
+    'wind_fraction': (['optimise_wind_fraction', 'default_wind_fraction', 'overbuild'], ['calc', 'coarse_walk_terms'],
+                      stage_wind_fraction),
+    'contributions': (['capacity_planning_lookahead'], ['renewables', 'adequate_gen'], stage_contributions),
+}
+
+# How many versions (for different parameters) of each stage simulation_stages() keeps.
+STAGE_VERSIONS = 4
+
+def simulation_stages(basedata, slots_per_hour, timestamps):
+    '''Returns a function stage(name, params) which runs one of the SIMULATION_STAGES on
+    basedata (and the stages it depends on), remembering the outputs for the parameters it
+    depends on.  Pass it to simulate() to reuse stages across simulations of the same data.'''
+    timestamps = parse_timestamps(timestamps)
+    outputs = {name: {} for name in SIMULATION_STAGES}
+
+    def key(name, params):
+        fields, deps, _ = SIMULATION_STAGES[name]
+        return tuple(repr(getattr(params, f)) for f in fields) + tuple(key(d.rstrip('()'), params) for d in deps)
+
+    def output(dep, params):
+        if dep.endswith('()'):
+            return functools.partial(stage, dep[:-2], params)
+        return stage(dep, params)
+
+    def stage(name, params):
+        fields, deps, fun = SIMULATION_STAGES[name]
+        k = key(name, params)
+        versions = outputs[name]
+        if k in versions:
+            versions[k] = versions.pop(k) # most recently used
+        else:
+            with span(f'stage:{name}'):
+                versions[k] = fun(basedata, params, slots_per_hour, timestamps, *[output(d, params) for d in deps])
+            while len(versions) > STAGE_VERSIONS:
+                del versions[next(iter(versions))]
+        return versions[k]
+    return stage
+
+@traced('simulate', lambda basedata, params, *args, **kwargs: {'data': params.filename, 'slots': basedata.shape[1]})
+def simulate(basedata, params, slots_per_hour, timestamps, quiet=False, stages=None):
+    '''Runs generation and storage against historical data, replacing any generators
+    not listed in `params.keep_generators` with renewable resources.  `stages` (from
+    simulation_stages()) lets simulations of the same data share the stages they have in
+    common.'''
+    year_slots = HOURS_PER_YEAR * slots_per_hour
     # Uncomment to consider just the last 2 years:
     # basedata = basedata[:, -year_slots*2:]; timestamps = timestamps[-year_slots*2:]
-    data = basedata.copy()
-    data[FIRST_GEN_COL:][data[FIRST_GEN_COL:] < 0] = 0
+    # We only copy the rows we need (as float32, if params.single_precision), so memory use
+    # doesn't depend on the number of generator columns.
+    if stages is None:
+        stages = simulation_stages(basedata, slots_per_hour, timestamps)
+    timestamps = parse_timestamps(timestamps)
     # Check whether a simulation is even possible (we can't get capacity factors for the region
     # unless we have both).  We will only include datapoints where wind and solar have each
     # averaged more than 2% of their nameplate generation in the surrounding several weeks.  If
     # that leaves less than a year of data overall, we're screwed anyway (levelised calcs fail).
-    missing_window_len = params.cf_filter_duration * slots_per_hour
-    adequate_wind_gen = centered_sma(data[WIND_COL], missing_window_len) > np.maximum.accumulate(data[WIND_COL]) * params.min_historical_cf
-    adequate_solar_gen = centered_sma(data[SOLAR_COL], missing_window_len) > np.maximum.accumulate(data[SOLAR_COL]) * params.min_historical_cf
-    adequate_gen = adequate_wind_gen & adequate_solar_gen
+    adequate_gen = stages('adequate_gen', params)
     num_adequate_slots = np.count_nonzero(adequate_gen)
     if num_adequate_slots < year_slots * 1.5:
         print(f'{params.filename}: insufficient renewables datapoints')
@@ -176,130 +540,550 @@ def simulate(basedata, params, slots_per_hour, timestamps, quiet=False):
     agi = np.nonzero(adequate_gen[1:] != adequate_gen[:-1])[0]
     if not adequate_gen[0]:
         agi = np.insert(agi, 0, 0)
-    discarded_ranges = [(j-i, timestamps[i], timestamps[j]) for i, j in zip(agi[::2], agi[1::2])]
-    data = data[:, adequate_gen]
-    timestamps = [ timestamps[i] for i, t in enumerate(adequate_gen) if t]
-    # OK, good to go.  Sum up all of the contributions we're keeping.
-    data_rows, data_hours = data.shape
-    nonrenewables_contribution = np.sum(data[params.keep_generators, :], axis=0)
-    if not params.isolate_region:
-        nonrenewables_contribution -= data[EXPORT_COL] # negative numbers are power imports
-    required_renewables = data[DEMAND_COL] - nonrenewables_contribution
-    required_renewables[required_renewables < 0] = 0
-    # Work out max and rolling average renewables demand
-    levelised_required_renewables = centered_sma(required_renewables, year_slots, year_slots)
-    max_levelised_required = np.maximum.accumulate(levelised_required_renewables)
-    max_nonlevelised_required = np.maximum.accumulate(required_renewables)
-    if lookahead_slots:
-        max_levelised_required[:-lookahead_slots] = max_levelised_required[lookahead_slots:]
-        max_levelised_required = np.maximum.accumulate(max_levelised_required, axis=-1)
-        max_nonlevelised_required[:-lookahead_slots] = max_nonlevelised_required[lookahead_slots:]
-        max_nonlevelised_required = np.maximum.accumulate(max_nonlevelised_required, axis=-1)
-    max_required = params.capacity_planning_percentile * max_nonlevelised_required + (1 - params.capacity_planning_percentile) * max_levelised_required
-    # Observed historical max power outputs and discount factors
-    historical_maxes = np.maximum.accumulate(data, axis=1)
-    if lookahead_slots:
-        historical_maxes[:, :-lookahead_slots] = historical_maxes[:, lookahead_slots:]
-        historical_maxes = np.maximum.accumulate(historical_maxes, axis=1)
-    cap_factors = np.divide(data, historical_maxes, out=np.zeros_like(historical_maxes), where=historical_maxes!=0)
-    levelised_wind_dcf = max(np.average(cap_factors[WIND_COL, :]), 0.001) # uncurtailed
-    levelised_solar_dcf = max(np.average(cap_factors[SOLAR_COL, :]), 0.001)
-    if params.calculate_dcf:
-        wind_dcf = levelised_wind_dcf # uncurtailed
-        solar_dcf = levelised_solar_dcf
-    else:
-        wind_dcf = params.default_wind_dcf
-        solar_dcf = params.default_solar_dcf
-    
-    # This function is returned for use by the optimiser
-    def calc_parameterised(wind_fraction, overbuild):
-        # Generation will be sized based on the maximum prior supply deficit (max_required).
-        max_overbuilt = max_required * (1 + overbuild)
-        wind_nameplate = (wind_fraction / wind_dcf) * max_overbuilt
-        solar_nameplate = ((1 - wind_fraction) / solar_dcf) * max_overbuilt
-        renewables_levelised = wind_nameplate * wind_dcf + solar_nameplate * solar_dcf # levelised annual output at each hour
-        # Power output based on historical weather
-        renewables_contribution = wind_nameplate * cap_factors[WIND_COL] + solar_nameplate * cap_factors[SOLAR_COL]
-        generated = nonrenewables_contribution + renewables_contribution
-        oversupply = generated - data[DEMAND_COL]
-        storage_hours_generated = oversupply / renewables_levelised # per hour
-        cum_storage = np.cumsum(storage_hours_generated)
-        return (wind_nameplate, solar_nameplate, storage_hours_generated, cum_storage)
+    discarded_ranges = [(int(j-i), format_timestamp(timestamps[i]), format_timestamp(timestamps[j])) for i, j in zip(agi[::2], agi[1::2])]
+    # OK, good to go.  The stages sum up all of the contributions we're keeping, size the
+    # renewables, and work out the capacity factors (from the observed historical max power
+    # outputs) and the discount factors.
+    data_hours = num_adequate_slots
+    timestamps = stages('kept', params)[2]
+    _, _, final_wind_max, final_solar_max = stages('cap_factors', params)
+    # This function is returned for use by the optimiser (as a partial, so its attributes are
+    # this simulation's, not the stage's).
+    calc_parameterised = functools.partial(stages('calc', params))
+    # The walk terms are only worked out when they are needed.
+    walk_terms = lambda: stages('walk_terms', params)
+    calc_parameterised.sweep = lambda wind_fractions, overbuilds: sweep_walks(
+        walk_terms(), wind_fractions, overbuilds, params.storage_hours, slots_per_hour)
+    calc_parameterised.solver = lambda tolerance=0.001: drawdown_solver(walk_terms(), slots_per_hour, tolerance,
+                                                                        stages('coarse_walk_terms', params))
+    calc_parameterised.walk_terms = walk_terms
+    calc_parameterised.timestamps = timestamps
+    calc_parameterised.drawdown_index = lambda wind_fraction, overbuild: drawdown_index(
+        calc_parameterised(wind_fraction, overbuild)[3])
 
     if not quiet:
-        wind_frac = params.default_wind_fraction
-        if params.optimise_wind_fraction:
-            wind_frac = optimise_wind_frac(calc_parameterised, params.overbuild)
+        wind_frac, coarse_storage = stages('wind_fraction', params)
         (wind_nameplate, solar_nameplate, storage_hours_generated, cum_storage
         ) = calc_parameterised(wind_frac, params.overbuild)
         
         max_drawdown, dd_start, dd_end = get_max_drawdown(cum_storage)
-        # We used to simulate a battery with a loop, but enumerating drawdowns makes a lot more sense.
-        # Unfortunately we lose the "curtailed" calculation.
-        half_drawdowns = get_drawdowns(cum_storage, max_drawdown / 2.0)
-        depletion = []
-        blackout_slots = 0
-        for _, s, e in get_drawdowns(cum_storage, params.storage_hours * slots_per_hour):
-            bs = s + np.argmax(cum_storage[s] - cum_storage[s:e] >= params.storage_hours * slots_per_hour)
-            depletion.append((timestamps[bs], timestamps[e]))
-            blackout_slots += e - bs
-
-        simulate_drawdowns = False
-
-        if simulate_drawdowns:
-            # No saturating arithmetic in numpy - have to loop.
-            clipped_drawdown = 0 # in storage-hours
-            curtailed_hours = 0
-            blackout_start = None
-            blackout_durations = []
-            blackout_starts = []
-            for i in range(data_hours):
-                storage_hours = storage_hours_generated[i]
-                clipped_drawdown += storage_hours
-                if storage_hours >= 0:
-                    if blackout_start is not None:
-                        blackout_starts.append(i)
-                        blackout_durations.append(i - blackout_start)
-                        blackout_start = None
-                    if clipped_drawdown > 0:
-                        curtailed_hours += clipped_drawdown
-                        clipped_drawdown = 0
-                else:
-                    if clipped_drawdown < -params.storage_hours * slots_per_hour:
-                        if blackout_start is None:
-                            blackout_start = i
-                        clipped_drawdown = -params.storage_hours * slots_per_hour
+        # Enumerating drawdowns tells us how much storage we need (run_storage() below is for
+        # curtailment, losses and power limits).
+        # (The timestamps are formatted a list at a time, as there can be thousands.)
+        _, half_drawdowns, hd_starts, hd_ends, _ = enumerate_drawdowns(cum_storage, max_drawdown / 2.0)
+        _, _, _, ends, depleted = enumerate_drawdowns(cum_storage, params.storage_hours * slots_per_hour)
+        depletion = list(zip(format_timestamps(timestamps[depleted]).tolist(), format_timestamps(timestamps[ends]).tolist()))
+        blackout_slots = np.sum(ends - depleted)
 
+        # Run a battery (which starts full), to find curtailment and blackouts with losses and power limits.
+        soc, curtailed, unserved = run_storage(
+            storage_hours_generated, params.storage_hours * slots_per_hour, params.storage_efficiency,
+            params.storage_charge_power, params.storage_discharge_power)
+        blackout_edges = np.flatnonzero(np.diff(unserved > 0, prepend=False, append=False))
+        blackout_starts, blackout_ends = blackout_edges[::2], blackout_edges[1::2]
 
         # Jarto wanted to see how much the existing capacity would be scaled up.
-        final_wind_multiple = wind_nameplate[-1] / historical_maxes[WIND_COL, -1]
-        final_solar_multiple = solar_nameplate[-1] / historical_maxes[SOLAR_COL, -1]
-
-        params.print_parameters()
-        print(f"Minimum storage required to avoid all blackouts (storage-hours): {max_drawdown/slots_per_hour:.1f}")
-        print(f"Duration of max drawdown (hours): {(dd_end-dd_start)/slots_per_hour:.1f} (period: {timestamps[dd_start]}-{timestamps[dd_end]})")
-        print(f"Wind fraction ({'optimised' if params.optimise_wind_fraction else 'default'}): {wind_frac:.2f}")
-        print(f"Percentage of time in blackout: {100*blackout_slots/data_hours:.3f}")
-        print(f"Battery empty (blackouts): {depletion}")
-        print(f"Drawdowns of over {max_drawdown/2/slots_per_hour:.1f} storage-hours: {'; '.join(list(map(lambda d: f'{d[0]/slots_per_hour:.1f} ({timestamps[d[1]]} - {timestamps[d[2]]})', half_drawdowns)))}")
-        print(f"Wind output scaled up by: {final_wind_multiple:.1f}")
-        print(f"Solar output scaled up by: {final_solar_multiple:.1f}")
-        if simulate_drawdowns:
-            print(f"Sim - Overproduction (curtailment), percent: {100*curtailed_hours/data_hours:.1f}")
-            print(f"Sim - Blackouts: {len(blackout_starts)}")
-            print(f"Sim - Percentage of time in blackout: {100*sum(blackout_durations)/data_hours:.1f}")
-            print(f"Sim - Blackout (start, duration) (hours): {list(zip(blackout_starts, blackout_durations))}")
-        print(f"Usable datapoints (percent): {100*data.shape[1]/basedata.shape[1]:.1f}")
-        print("Historical contributions by source:")
-        print("           Min CF   Avg CF    Min Contr.  Avg Contr.  Max Contr.")
-        contrib = data / data[TOTAL_GEN_COL]
-        for i in range(FIRST_GEN_COL, len(eia_cols)):
-            print(f'{eia_cols[i]:8} {cap_factors[i].min():8.3f} {np.average(cap_factors[i]):8.3f} {contrib[i].min():11.3f} {np.average(contrib[i]):11.3f} {contrib[i].max():11.3f}')
-        print(f"Discarded data points: {discarded_ranges}")
+        final_wind_multiple = wind_nameplate[-1] / final_wind_max
+        final_solar_multiple = solar_nameplate[-1] / final_solar_max
+
+        contributions = stages('contributions', params)
+
+        # Everything we print, so that simulate_cached() can store it.
+        calc_parameterised.results = {
+            'storage_required': float(max_drawdown / slots_per_hour),
+            'max_drawdown': (float((dd_end - dd_start) / slots_per_hour), format_timestamp(timestamps[dd_start]), format_timestamp(timestamps[dd_end])),
+            'wind_fraction': float(wind_frac),
+            'coarse_error': None if coarse_storage is None else float(max(max_drawdown / slots_per_hour - coarse_storage, 0)),
+            'blackout_percent': float(100 * blackout_slots / data_hours),
+            'depletion': depletion,
+            'half_drawdown': float(max_drawdown / 2 / slots_per_hour),
+            'half_drawdowns': list(zip((half_drawdowns / slots_per_hour).tolist(), format_timestamps(timestamps[hd_starts]).tolist(),
+                                       format_timestamps(timestamps[hd_ends]).tolist())),
+            'wind_multiple': float(final_wind_multiple),
+            'solar_multiple': float(final_solar_multiple),
+            'curtailed_percent': float(100 * np.sum(curtailed) / data_hours),
+            'unserved_percent': float(100 * np.sum(unserved) / data_hours),
+            'blackouts': list(zip(format_timestamps(timestamps[blackout_starts]).tolist(),
+                                  ((blackout_ends - blackout_starts) / slots_per_hour).tolist())),
+            'blackout_time_percent': float(100 * np.count_nonzero(unserved) / data_hours),
+            'usable_percent': float(100 * data_hours / basedata.shape[1]),
+            'contributions': contributions,
+            'discarded_ranges': discarded_ranges,
+        }
+        print_results(params, calc_parameterised.results)
 
     return calc_parameterised
 
+def print_results(params, results):
+    '''Prints a simulation's results (see simulate())'''
+    r = results
+    params.print_parameters()
+    print(f"Minimum storage required to avoid all blackouts (storage-hours): {r['storage_required']:.1f}")
+    print(f"Duration of max drawdown (hours): {r['max_drawdown'][0]:.1f} (period: {r['max_drawdown'][1]}-{r['max_drawdown'][2]})")
+    print(f"Wind fraction ({'optimised' if params.optimise_wind_fraction else 'default'}): {r['wind_fraction']:.2f}")
+    if r.get('coarse_error') is not None:
+        print(f"Optimised on {params.coarse_optimise_hours}-hour sums: within {r['coarse_error']:.2f} storage-hours of the minimum")
+    print(f"Percentage of time in blackout: {r['blackout_percent']:.3f}")
+    print(f"Battery empty (blackouts): {[tuple(d) for d in r['depletion']]}")
+    print(f"Drawdowns of over {r['half_drawdown']:.1f} storage-hours: {'; '.join(f'{d[0]:.1f} ({d[1]} - {d[2]})' for d in r['half_drawdowns'])}")
+    print(f"Wind output scaled up by: {r['wind_multiple']:.1f}")
+    print(f"Solar output scaled up by: {r['solar_multiple']:.1f}")
+    print(f"Sim - Overproduction (curtailment), percent: {r['curtailed_percent']:.1f}")
+    print(f"Sim - Unserved demand, percent: {r['unserved_percent']:.3f}")
+    print(f"Sim - Blackouts: {len(r['blackouts'])}")
+    print(f"Sim - Percentage of time in blackout: {r['blackout_time_percent']:.3f}")
+    print(f"Sim - Blackout (start, duration) (hours): {[tuple(b) for b in r['blackouts']]}")
+    print(f"Usable datapoints (percent): {r['usable_percent']:.1f}")
+    print("Historical contributions by source:")
+    print("           Min CF   Avg CF    Min Contr.  Avg Contr.  Max Contr.")
+    for name, min_cf, avg_cf, min_contrib, avg_contrib, max_contrib in r['contributions']:
+        print(f'{name:8} {min_cf:8.3f} {avg_cf:8.3f} {min_contrib:11.3f} {avg_contrib:11.3f} {max_contrib:11.3f}')
+    print(f"Discarded data points: {[tuple(d) for d in r['discarded_ranges']]}")
+
+# simulate_cached() keeps results in CACHE_DIR/results, and evicts the least recently used ones
+# when they take up more than this.
+RESULT_CACHE_BYTES = 1 << 26
+# Bump this when a change to the simulation changes its results (so old ones, and old
+# update_simulation() states, aren't used).  2: centered_sma() ends on short series.
+RESULT_FORMAT = 2
+
+def simulation_key(basedata, params, slots_per_hour, timestamps):
+    '''A hash of everything a simulation depends on: the data, the timestamps, slots_per_hour
+    and the parameters (but not the label)'''
+    h = hashlib.sha1(repr((RESULT_FORMAT, basedata.shape, basedata.dtype.str, slots_per_hour,
+                           [(k, getattr(params, k)) for k in params.parameter_defaults()])).encode())
+    for row in basedata:
+        h.update(np.ascontiguousarray(row))
+    h.update(np.ascontiguousarray(parse_timestamps(timestamps)))
+    return h.hexdigest()
+
+def read_result(key):
+    '''Returns the cached results for a simulation key, or None'''
+    fname = f'{CACHE_DIR}/results/{key}.json'
+    try:
+        with open(fname) as f:
+            results = json.load(f)
+        os.utime(fname) # it's been used
+        return results
+    except (OSError, ValueError):
+        return None
+
+def write_result(key, results, max_bytes=None):
+    '''Caches the results for a simulation key, then evicts the least recently used results
+    (other than these) until the cache fits in max_bytes (default RESULT_CACHE_BYTES)'''
+    if max_bytes is None:
+        max_bytes = RESULT_CACHE_BYTES
+    dir = f'{CACHE_DIR}/results'
+    os.makedirs(dir, exist_ok=True)
+    with open(f'{dir}/{key}.json.{os.getpid()}.tmp', 'w') as f:
+        json.dump(results, f)
+    os.replace(f'{dir}/{key}.json.{os.getpid()}.tmp', f'{dir}/{key}.json')
+    entries = []
+    for fn in os.listdir(dir):
+        if fn == f'{key}.json':
+            continue
+        with contextlib.suppress(OSError): # another process may have evicted it
+            st = os.stat(f'{dir}/{fn}')
+            entries.append((st.st_mtime, st.st_size, fn))
+    total = os.path.getsize(f'{dir}/{key}.json') + sum(size for _, size, _ in entries)
+    for _, size, fn in sorted(entries):
+        if total <= max_bytes:
+            break
+        with contextlib.suppress(OSError):
+            os.remove(f'{dir}/{fn}')
+        total -= size
+
+def simulate_cached(basedata, params, slots_per_hour, timestamps):
+    '''simulate() and print the results, unless they're cached (from a run with the same data
+    and parameters).  Returns the results (see print_results()), or None if there wasn't
+    enough data to simulate.'''
+    if not CACHE_DIR:
+        cpfun = simulate(basedata, params, slots_per_hour, timestamps)
+        return cpfun.results if cpfun else None
+    key = simulation_key(basedata, params, slots_per_hour, timestamps)
+    results = read_result(key)
+    if results is None:
+        cpfun = simulate(basedata, params, slots_per_hour, timestamps)
+        results = cpfun.results if cpfun else {'insufficient_data': True}
+        write_result(key, results)
+    elif results.get('insufficient_data'):
+        print(f'{params.filename}: insufficient renewables datapoints')
+    else:
+        print_results(params, results)
+    return None if results.get('insufficient_data') else results
+
+# The blocks run_storage() scans (in slots).  Each scan step covers every block at once, and
+# we step from block to block in python, so 256 balances the two.
+STORAGE_BLOCK = 256
+
+@traced('run_storage')
+def run_storage(supply, capacity, efficiency=1, charge_power=None, discharge_power=None, initial=None):
+    '''Runs a battery of the given capacity over a vector of the power available for storage
+    in each slot (negative when demand isn't met), in storage-hours per hour.  Charging loses
+    (1 - efficiency) (the round trip efficiency) and is limited to charge_power, discharging is
+    limited to discharge_power, and the battery starts at initial (default: full).  Returns the
+    (state of charge, curtailed, unserved) in each slot.  supply can also be a 2-D array, to
+    run a battery for each row at once (capacity and initial can then be per row).
+
+    The battery level after each slot is clip(level + delta, 0, capacity).  A chain of those is
+    always clip(level + D, L, H) for some (D, L, H), so we can find the chains for whole blocks
+    of slots with a scan, and only need to step from block to block.'''
+    supply = np.asarray(supply, dtype=float)
+    rows = supply.shape[:-1]
+    capacity = np.broadcast_to(np.asarray(capacity, dtype=float), rows)[..., np.newaxis]
+    initial = capacity if initial is None else np.broadcast_to(np.asarray(initial, dtype=float), rows)[..., np.newaxis]
+    charge_power = np.inf if charge_power is None else charge_power
+    discharge_power = np.inf if discharge_power is None else discharge_power
+    delta = np.minimum(supply, charge_power)
+    delta[delta > 0] *= efficiency
+    np.maximum(delta, -discharge_power, out=delta)
+    slots = delta.shape[-1]
+    blocks = -(-slots // STORAGE_BLOCK)
+    D = np.zeros(rows + (blocks * STORAGE_BLOCK,))
+    D[..., :slots] = delta
+    D = D.reshape(rows + (blocks, STORAGE_BLOCK))
+    L = np.zeros_like(D)
+    H = np.empty_like(D)
+    H[...] = capacity[..., np.newaxis]
+    # Hillis-Steele scan: after the step with stride k, each slot has the chain of the 2k slots up to it.
+    k = 1
+    while k < STORAGE_BLOCK:
+        lo = L[..., :-k] + D[..., k:]
+        np.minimum(np.maximum(lo, L[..., k:], out=lo), H[..., k:], out=lo)
+        hi = H[..., :-k] + D[..., k:]
+        np.minimum(np.maximum(hi, L[..., k:], out=hi), H[..., k:], out=hi)
+        L[..., k:] = lo
+        H[..., k:] = hi
+        D[..., k:] += D[..., :-k]
+        k *= 2
+    # Step from block to block (for every row at once).
+    block_levels = np.empty(rows + (blocks, 1))
+    level = initial[..., 0]
+    block_ends = [np.moveaxis(a[..., -1], -1, 0) for a in (D, L, H)]
+    for b, (d, l, h) in enumerate(zip(*block_ends)):
+        block_levels[..., b, 0] = level
+        level = np.minimum(np.maximum(level + d, l), h)
+    soc = np.minimum(np.maximum(block_levels + D, L, out=D), H, out=D).reshape(rows + (-1,))[..., :slots]
+    unclipped = np.concatenate((initial, soc[..., :-1]), axis=-1) + delta
+    curtailed = np.maximum(supply - charge_power, 0) + np.maximum(unclipped - capacity, 0) / efficiency
+    unserved = np.maximum(-supply - discharge_power, 0) + np.maximum(-unclipped, 0)
+    return soc, curtailed, unserved
+
+# Limits the memory used by sweep_walks (each block of walks is about this big).  Small
+# blocks are faster, as they stay in the CPU cache.
+SWEEP_BLOCK_BYTES = 1 << 22
+
+def sweep_walks(walk_terms, wind_fractions, overbuilds, storage_hours, slots_per_hour):
+    '''Evaluates the storage walks for every combination of wind fraction and overbuild, in
+    blocks of walks at a time.  Returns a (wind fractions, overbuilds) grid of max_drawdown
+    (storage-hours), dd_start and dd_end (slot indices) and blackout_fraction (the fraction of
+    the time spent in blackout, given storage_hours of storage).'''
+    wind_fractions = np.asarray(wind_fractions, dtype=float)
+    overbuilds = np.asarray(overbuilds, dtype=float)
+    wf, ob = [g.ravel() for g in np.meshgrid(wind_fractions, overbuilds, indexing='ij')]
+    coefs = np.stack([1 / (1 + ob), wf, 1 - wf], axis=1)
+    results = np.zeros(wf.shape, dtype=[('max_drawdown', float), ('dd_start', int), ('dd_end', int),
+                                        ('blackout_fraction', float)])
+    data_slots = walk_terms.shape[1]
+    block = max(1, SWEEP_BLOCK_BYTES // (8 * data_slots))
+    for b in range(0, len(coefs), block):
+        walks = np.cumsum(coefs[b:b+block] @ walk_terms, axis=1)
+        drawdowns = np.maximum.accumulate(walks, axis=1)
+        drawdowns -= walks
+        dd_end = np.argmax(drawdowns, axis=1)
+        max_drawdown = drawdowns[np.arange(len(walks)), dd_end]
+        dd_start = [np.argmax(walk[:e]) if e else e for walk, e in zip(walks, dd_end)]
+        out = results[b:b+block]
+        out['max_drawdown'] = max_drawdown / slots_per_hour
+        out['dd_start'] = dd_start
+        out['dd_end'] = dd_end
+        # Only walks which run the storage dry can have blackouts.
+        storage_slots = storage_hours * slots_per_hour
+        dry = np.flatnonzero(max_drawdown >= storage_slots)
+        row, _, _, ends, depleted = enumerate_drawdowns(walks[dry], storage_slots)
+        out['blackout_fraction'][dry] = np.bincount(row, ends - depleted, len(dry)) / data_slots
+    return results.reshape(len(wind_fractions), len(overbuilds))
+
+def suffix_sma(vec, sma, start, window):
+    '''Returns centered_sma(vec[start:], window), given sma = centered_sma(vec, window).
+    Only the initial values (filled in from the following season) differ.'''
+    icols = window // 2
+    if len(vec) - start < 2 * window + icols:
+        return centered_sma(vec[start:], window)
+    out = sma[start:].copy()
+    out[:icols] = sma[start + window:start + window + icols]
+    return out
+
+def suffix_running_max(vec, running_max, start):
+    '''Returns np.maximum.accumulate(vec[start:]), given running_max (that of vec).  The two
+    are the same from the first point which reaches the earlier maximum.'''
+    if not start:
+        return running_max.copy()
+    caught_up = np.argmax(vec[start:] >= running_max[start - 1])
+    if vec[start + caught_up] < running_max[start - 1]:
+        return np.maximum.accumulate(vec[start:])
+    out = running_max[start:].copy()
+    out[:caught_up] = np.maximum.accumulate(vec[start:start + caught_up])
+    return out
+
+def start_date_scan(basedata, params, slots_per_hour, timestamps, step, quiet=False):
+    '''Finds the storage required by simulate(basedata[:, i:], ...) for start slots i = 0, step,
+    2*step ... (while at least a year of data remains), to show how the results are affected by
+    data (and startup) artifacts.  The clipping, the nonrenewables and the renewables filter are
+    worked out once, and each start slot then only needs the walk.  Returns a list of (start,
+    usable fraction, wind fraction, max_drawdown (storage-hours), dd_start, dd_end), with the
+    slot indices relative to basedata.'''
+    year_slots = HOURS_PER_YEAR * slots_per_hour
+    lookahead_slots = params.capacity_planning_lookahead * slots_per_hour
+    missing_window_len = params.cf_filter_duration * slots_per_hour
+    timestamps = parse_timestamps(timestamps)
+    demand = basedata[DEMAND_COL]
+    nonrenewables_contribution = nonrenewable_supply(basedata, params)
+    wind, solar = series(basedata, WIND_COL), series(basedata, SOLAR_COL)
+    wind_sma = centered_sma(wind, missing_window_len)
+    solar_sma = centered_sma(solar, missing_window_len)
+    wind_max = np.maximum.accumulate(wind)
+    solar_max = np.maximum.accumulate(solar)
+    results = []
+    for start in range(0, basedata.shape[1] - year_slots, step):
+        adequate_gen = ((suffix_sma(wind, wind_sma, start, missing_window_len) >
+                         suffix_running_max(wind, wind_max, start) * params.min_historical_cf) &
+                        (suffix_sma(solar, solar_sma, start, missing_window_len) >
+                         suffix_running_max(solar, solar_max, start) * params.min_historical_cf))
+        if np.count_nonzero(adequate_gen) < year_slots * 1.5:
+            if not quiet:
+                print(f'{format_timestamp(timestamps[start])}: insufficient renewables datapoints')
+            continue
+        (slots,) = np.nonzero(adequate_gen)
+        slots += start
+        required_renewables = demand[slots] - nonrenewables_contribution[slots]
+        required_renewables[required_renewables < 0] = 0
+        max_required = required_capacity(required_renewables, params, slots_per_hour)
+        _, cap_factors = capacity_factors(np.stack([wind[slots], solar[slots]]), lookahead_slots)
+        wind_dcf, solar_dcf = discount_factors(cap_factors[0], cap_factors[1], params)
+        walk_terms = storage_walk_terms(demand[slots], nonrenewables_contribution[slots], max_required,
+                                        wind_dcf, cap_factors[0], solar_dcf, cap_factors[1])
+        calc_walk = walk_parameterised(walk_terms)
+        wind_frac = params.default_wind_fraction
+        if params.optimise_wind_fraction:
+            wind_frac = optimise_wind_frac(calc_walk, params.overbuild)
+        max_drawdown, dd_start, dd_end = get_max_drawdown(calc_walk(wind_frac, params.overbuild)[3])
+        results.append((start, len(slots) / (basedata.shape[1] - start), wind_frac,
+                        max_drawdown / slots_per_hour, slots[dd_start], slots[dd_end]))
+    if quiet:
+        return results
+
+    labels = format_timestamps(timestamps)
+    params.print_parameters()
+    print("Start date           Usable %  Wind frac  Storage-hours  Change %  Max drawdown period")
+    previous = None
+    for start, usable, wind_frac, storage, dd_start, dd_end in results:
+        change = f'{100 * (storage - previous) / previous:8.1f}' if previous else ' ' * 8
+        print(f'{labels[start]:20} {100 * usable:8.1f} {wind_frac:10.2f} {storage:14.1f}  {change}  {labels[dd_start]}-{labels[dd_end]}')
+        previous = storage
+    # Find the first start date after which the storage required stays within 5% of it.
+    settled = None
+    low = high = None
+    for start, _, _, storage, _, _ in reversed(results):
+        low = storage if low is None else min(low, storage)
+        high = storage if high is None else max(high, storage)
+        if high > storage * 1.05 or low < storage * 0.95:
+            break
+        settled = start
+    if settled is not None:
+        print(f"Storage required settles (to within 5%) for start dates from: {labels[settled]}")
+    return results
+
+# Appending new data to a simulation (see update_simulation()).  The new slots change the rolling
+# averages whose windows reach them, and the capacities planned from the lookahead before those,
+# so only they (and the walk after them) are recalculated.
+def extend_running_max(old, vec, first):
+    '''Returns np.maximum.accumulate(vec), given old (the same, for a vector which matched vec
+    before slot first)'''
+    out = np.empty(len(vec))
+    out[:first] = old[:first]
+    out[first:] = np.maximum.accumulate(vec[first:])
+    if first:
+        np.maximum(out[first:], out[first - 1], out=out[first:])
+    return out
+
+def extend_running_argmax(old, tail, first, before=-np.inf):
+    '''Returns the index of the (first) maximum of vec[:i+1] for each i, given old (the same,
+    for a vector which matched vec before slot first), tail (vec[first:]) and before (the
+    maximum of vec[:first])'''
+    out = np.empty(first + len(tail), dtype=np.int64)
+    out[:first] = old[:first]
+    if len(tail):
+        best = np.maximum(np.maximum.accumulate(tail), before)
+        new_best = tail > np.concatenate(([before], best[:-1]))
+        out[first:] = np.maximum.accumulate(np.where(new_best, np.arange(first, len(out)), out[first - 1] if first else 0))
+    return out
+
+def extend_centered_sma(old, vec, first, lookahead, season_len=None):
+    '''Returns centered_sma(vec, lookahead, season_len), given old (the same, for a vector which
+    matched vec before slot first).  Only the averages whose windows reach slot first (and the
+    final values, filled in from the preceding season) are worked out.'''
+    if not season_len:
+        season_len = lookahead
+    icols = lookahead // 2
+    fcols = lookahead - icols
+    start = max(first - fcols, 0)
+    if start < season_len + icols or start >= len(vec) - fcols:
+        return centered_sma(vec, lookahead, season_len)
+    out = np.empty(len(vec))
+    out[:start] = old[:start]
+    out[start:-fcols] = rolling_sums(vec[start - icols:], lookahead)[1:] / lookahead
+    out[-fcols:] = out[-fcols-season_len:-season_len]
+    return out
+
+# The arrays update_simulation() keeps.  The raw slots' renewables filter (see
+# adequate_generation()) and its averages and maxima, then (in the slots it keeps) the required
+# renewables and their averages and maxima, the maxima of wind and solar, the running totals of
+# the storage_walk_terms() (unscaled by the discount factors), and the walk for the wind fraction
+# and overbuild (with the index of its running peak and deepest drawdown at each slot).
+SIMULATION_STATE = ['adequate', 'wind_sma', 'solar_sma', 'wind_max', 'solar_max',
+                    'required', 'levelised', 'required_max', 'levelised_max', 'wind_kept_max', 'solar_kept_max',
+                    'cum_terms', 'coefs', 'wind_fraction', 'walk', 'peak_at', 'dd_end_at']
+
+@traced('update_simulation', lambda basedata, params, *args, **kwargs: {'data': params.filename, 'slots': basedata.shape[1]})
+def update_simulation(basedata, params, slots_per_hour, state=None):
+    '''Works out simulate()'s storage walk (for its wind fraction and overbuild), and returns a
+    state (a dict of the SIMULATION_STATE arrays) it can be updated from when more slots are
+    added to basedata, and the first (kept) slot it recalculated.  The walk's max drawdown is
+    the storage required (see state_drawdown()).  Returns None if there isn't enough data.
+
+    Everything before the slots the new ones can affect is kept, and the rest is recalculated
+    from the old maxima and running totals.  The walk itself is only kept if the discount
+    factors and wind fraction haven't changed (otherwise it's recombined from the totals).'''
+    year_slots = HOURS_PER_YEAR * slots_per_hour
+    lookahead_slots = params.capacity_planning_lookahead * slots_per_hour
+    missing_window_len = params.cf_filter_duration * slots_per_hour
+    if state is None:
+        state = dict({name: np.zeros(0) for name in SIMULATION_STATE}, cum_terms=np.zeros((3, 0)))
+    old_slots = len(state['adequate'])
+    wind, solar = series(basedata, WIND_COL), series(basedata, SOLAR_COL)
+    wind_sma = extend_centered_sma(state['wind_sma'], wind, old_slots, missing_window_len)
+    solar_sma = extend_centered_sma(state['solar_sma'], solar, old_slots, missing_window_len)
+    wind_max = extend_running_max(state['wind_max'], wind, old_slots)
+    solar_max = extend_running_max(state['solar_max'], solar, old_slots)
+    first = max(old_slots - (missing_window_len - missing_window_len // 2), 0)
+    adequate = np.concatenate((state['adequate'][:first].astype(bool),
+        (wind_sma[first:] > wind_max[first:] * params.min_historical_cf) &
+        (solar_sma[first:] > solar_max[first:] * params.min_historical_cf)))
+    if np.count_nonzero(adequate) < year_slots * 1.5:
+        return None
+    # The rest is in the slots we keep.
+    (kept,) = np.nonzero(adequate)
+    old_kept = len(state['required'])
+    first = np.count_nonzero(state['adequate'][:first])
+    demand = series(basedata, DEMAND_COL, kept)
+    nonrenewables_contribution = nonrenewable_supply(basedata, params, kept)
+    wind, solar = wind[kept], solar[kept]
+    required = np.maximum(demand - nonrenewables_contribution, 0)
+    levelised = extend_centered_sma(state['levelised'], required, first, year_slots, year_slots)
+    required_max = extend_running_max(state['required_max'], required, first)
+    wind_kept_max = extend_running_max(state['wind_kept_max'], wind, first)
+    solar_kept_max = extend_running_max(state['solar_kept_max'], solar, first)
+    levelised_first = max(first - (year_slots - year_slots // 2), 0)
+    levelised_max = extend_running_max(state['levelised_max'], levelised, levelised_first)
+    if params.capacity_planning_percentile < 1:
+        first = levelised_first
+    # See lookahead_max() (which doesn't look ahead if the lookahead is longer than the data).
+    looking_ahead = lambda slots: bool(lookahead_slots) and lookahead_slots < slots
+    first = max(first - lookahead_slots, 0) if looking_ahead(old_kept) == looking_ahead(len(kept)) else 0
+    ahead = np.arange(first, len(kept))
+    if looking_ahead(len(kept)):
+        ahead = np.minimum(ahead + lookahead_slots, len(kept) - 1)
+    max_required = (params.capacity_planning_percentile * required_max[ahead] +
+                    (1 - params.capacity_planning_percentile) * levelised_max[ahead])
+    terms = np.array([(nonrenewables_contribution[first:] - demand[first:]) / max_required,
+                      np.divide(wind[first:], wind_kept_max[ahead], out=np.zeros(len(ahead)), where=wind_kept_max[ahead]!=0),
+                      np.divide(solar[first:], solar_kept_max[ahead], out=np.zeros(len(ahead)), where=solar_kept_max[ahead]!=0)])
+    np.cumsum(terms, axis=1, out=terms)
+    if first:
+        terms += state['cum_terms'][:, first - 1:first]
+    cum_terms = np.concatenate((state['cum_terms'][:, :first], terms), axis=1)
+    # The walk (see storage_walk_terms()), scaled by the discount factors (see discount_factors()).
+    wind_dcf, solar_dcf = params.default_wind_dcf, params.default_solar_dcf
+    if params.calculate_dcf:
+        wind_dcf, solar_dcf = [max(total / len(kept), 0.001) for total in cum_terms[1:, -1]]
+    walk_coefs = lambda wind_fraction, overbuild: np.array([1 / (1 + overbuild), wind_fraction / wind_dcf, (1 - wind_fraction) / solar_dcf])
+    wind_frac = params.default_wind_fraction
+    if params.optimise_wind_fraction:
+        wind_frac = optimise_wind_frac(lambda wf, ob: (None, None, None, walk_coefs(wf, ob) @ cum_terms), params.overbuild)
+    coefs = walk_coefs(wind_frac, params.overbuild)
+    if not np.array_equal(coefs, state['coefs']):
+        first = 0
+    walk = np.concatenate((state['walk'][:first], coefs @ cum_terms[:, first:]))
+    peak_at = extend_running_argmax(state['peak_at'], walk[first:], first, walk[state['peak_at'][first - 1]] if first else -np.inf)
+    dd_end_at = state['dd_end_at']
+    deepest = walk[peak_at[dd_end_at[first - 1]]] - walk[dd_end_at[first - 1]] if first else -np.inf
+    dd_end_at = extend_running_argmax(dd_end_at, walk[peak_at[first:]] - walk[first:], first, deepest)
+    return {'adequate': adequate, 'wind_sma': wind_sma, 'solar_sma': solar_sma, 'wind_max': wind_max,
+            'solar_max': solar_max, 'required': required, 'levelised': levelised, 'required_max': required_max,
+            'levelised_max': levelised_max, 'wind_kept_max': wind_kept_max, 'solar_kept_max': solar_kept_max,
+            'cum_terms': cum_terms, 'coefs': coefs, 'wind_fraction': np.array(wind_frac), 'walk': walk,
+            'peak_at': peak_at, 'dd_end_at': dd_end_at}, first
+
+def state_drawdown(state):
+    '''The (max_drawdown, dd_start, dd_end) of an update_simulation() state's walk (see
+    get_max_drawdown()), with the slots indexing the kept slots'''
+    dd_end = int(state['dd_end_at'][-1])
+    dd_start = int(state['peak_at'][dd_end])
+    return state['walk'][dd_start] - state['walk'][dd_end], dd_start, dd_end
+
+def state_entry(basedata, params, slots_per_hour):
+    '''The cache entry an update_simulation() state is saved in'''
+    return cache_entry(f'state-{os.path.basename(params.filename)}',
+                       (RESULT_FORMAT, basedata.shape[0], slots_per_hour, [(k, getattr(params, k)) for k in params.parameter_defaults()]))
+
+def read_simulation_state(entry, basedata):
+    '''Returns the saved update_simulation() state, if it's for a prefix of basedata (the
+    slots it covers are unchanged), or None'''
+    try:
+        with open(f'{entry}.json') as f:
+            meta = json.load(f)
+        if meta['slots'] > basedata.shape[1] or meta['digest'] != hashlib.sha1(
+                np.ascontiguousarray(basedata[:, :meta['slots']])).hexdigest():
+            return None
+        return {name: np.load(f'{entry}.{name}.npy', mmap_mode='r') for name in SIMULATION_STATE}
+    except (OSError, ValueError, KeyError):
+        return None
+
+def write_simulation_state(entry, basedata, state):
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    for name in SIMULATION_STATE:
+        save_npy(f'{entry}.{name}.npy', state[name])
+    slots = len(state['adequate'])
+    write_cache_meta(entry, {'slots': slots, 'digest': hashlib.sha1(np.ascontiguousarray(basedata[:, :slots])).hexdigest()})
+
+def append_simulation(basedata, params, slots_per_hour, timestamps):
+    '''Prints the storage basedata needs (as simulate() does, without the details), updating
+    the state saved by the last run rather than starting again, if basedata has only had slots
+    added since.  Returns the state.'''
+    timestamps = parse_timestamps(timestamps)
+    entry = state_entry(basedata, params, slots_per_hour) if CACHE_DIR else None
+    state = read_simulation_state(entry, basedata) if entry else None
+    old_slots = len(state['adequate']) if state else 0
+    updated = update_simulation(basedata, params, slots_per_hour, state)
+    if updated is None:
+        print(f'{params.filename}: insufficient renewables datapoints')
+        return None
+    state, first = updated
+    if entry:
+        write_simulation_state(entry, basedata, state)
+    kept_timestamps = timestamps[state['adequate']]
+    max_drawdown, dd_start, dd_end = state_drawdown(state)
+    print(f"{params.filename}: {basedata.shape[1] - old_slots} new slots (to {format_timestamp(timestamps[-1])}), "
+          f"recalculated from {format_timestamp(kept_timestamps[first])}")
+    print(f"Minimum storage required to avoid all blackouts (storage-hours): {max_drawdown / slots_per_hour:.1f}")
+    print(f"Duration of max drawdown (hours): {(dd_end - dd_start) / slots_per_hour:.1f} "
+          f"(period: {format_timestamp(kept_timestamps[dd_start])}-{format_timestamp(kept_timestamps[dd_end])})")
+    print(f"Wind fraction ({'optimised' if params.optimise_wind_fraction else 'default'}): {float(state['wind_fraction']):.2f}")
+    return state
+
 # Minimise the maximum drawdown by adjusting the wind fraction
+@traced('optimise_wind_frac')
 def optimise_wind_frac(cpfun, overbuild):
     wind_min = 0
     wind_max = 1
@@ -317,45 +1101,443 @@ def optimise_wind_frac(cpfun, overbuild):
     return wind_min
 
 
+GOLDEN_RATIO = (np.sqrt(5) - 1) / 2
+
+def golden_section(fun, lo, hi, tolerance):
+    '''Minimises a convex (or at least unimodal) function on [lo, hi], to within tolerance.
+    Needs one evaluation per step (plus the ends).  Returns (x, fun(x)).'''
+    a, b = lo, hi
+    c, d = b - GOLDEN_RATIO * (b - a), a + GOLDEN_RATIO * (b - a)
+    fc, fd = fun(c), fun(d)
+    while b - a > tolerance:
+        if fc <= fd:
+            b, d, fd = d, c, fc
+            c = b - GOLDEN_RATIO * (b - a)
+            fc = fun(c)
+        else:
+            a, c, fc = c, d, fd
+            d = a + GOLDEN_RATIO * (b - a)
+            fd = fun(d)
+    # The minimum is often at one end (e.g. when wind just makes things worse).
+    return min([(c, fc), (d, fd), (lo, fun(lo)), (hi, fun(hi))], key=lambda p: p[1])
+
+def coarse_slots(params, slots_per_hour):
+    '''The slots in each of params.coarse_optimise_hours' blocks (1 if there are none)'''
+    return (params.coarse_optimise_hours or 0) * slots_per_hour or 1
+
+def coarse_walk_terms(walk_terms, block_slots):
+    '''Sums storage_walk_terms() over blocks of block_slots (the last may be shorter).  Walks on
+    these are the full resolution walks sampled at the end of each block, so their drawdowns
+    are never larger: the swings within a block are missed.'''
+    return np.add.reduceat(walk_terms, np.arange(0, walk_terms.shape[1], block_slots), axis=1)
+
+def drawdown_solver(walk_terms, slots_per_hour, tolerance=0.001, coarse_terms=None):
+    '''Returns a function giving the storage (storage-hours) needed to avoid all blackouts, for
+    a (wind_fraction, overbuild), given simulate()'s storage_walk_terms().  It remembers every
+    point it has evaluated, and has these solvers attached:
+
+    best_wind_fraction(overbuild) -> (wind_fraction, storage_hours)
+        Given coarse_terms (the walk_terms summed over blocks, see coarse_walk_terms()), the
+        wind fraction is optimised on those, and only the storage it needs is worked out at
+        full resolution.  coarse_error(overbuild) bounds how much more that is than the
+        minimum.
+    min_overbuild(storage_hours, max_overbuild=10) -> (overbuild, wind_fraction, storage_hours)
+        The smallest overbuild which needs no more than storage_hours (None if max_overbuild
+        isn't enough).
+    cheapest(storage_hour_cost, max_overbuild=10) -> (overbuild, wind_fraction, storage_hours)
+        Minimises overbuild + storage_hour_cost * storage_hours (where an overbuild of 1 costs
+        as much as the base renewables).
+
+    The walk is deficit/(1+overbuild) + wind_fraction*wind + (1-wind_fraction)*solar, so its max
+    drawdown is convex in (1/(1+overbuild), wind_fraction), and so is the cost.  That lets us
+    use golden section searches (and bisection) rather than sweeping the whole grid.'''
+    coarse = None
+    if coarse_terms is not None:
+        coarse = drawdown_solver(coarse_terms, slots_per_hour, tolerance)
+    cum_deficit, cum_wind, cum_solar = np.cumsum(walk_terms, axis=1)
+    cum_wind -= cum_solar
+    storage = {}
+    best_fractions = {}
+
+    def storage_hours(wind_fraction, overbuild):
+        key = (wind_fraction, overbuild)
+        if key not in storage:
+            walk = cum_deficit / (1 + overbuild) + wind_fraction * cum_wind + cum_solar
+            storage[key] = np.max(np.maximum.accumulate(walk) - walk) / slots_per_hour
+        return storage[key]
+
+    def best_wind_fraction(overbuild):
+        if overbuild not in best_fractions:
+            if coarse is None:
+                best_fractions[overbuild] = golden_section(lambda wf: storage_hours(wf, overbuild), 0, 1, tolerance)
+            else:
+                wind_fraction, _ = coarse.best_wind_fraction(overbuild)
+                best_fractions[overbuild] = wind_fraction, storage_hours(wind_fraction, overbuild)
+        return best_fractions[overbuild]
+
+    def coarse_error(overbuild):
+        if coarse is None:
+            return 0
+        return max(best_wind_fraction(overbuild)[1] - coarse.best_wind_fraction(overbuild)[1], 0)
+
+    def solution(base_fraction):
+        overbuild = 1 / base_fraction - 1
+        return (overbuild,) + best_wind_fraction(overbuild)
+
+    def min_overbuild(target_hours, max_overbuild=10):
+        # Bisect on the base fraction (1/(1+overbuild)).  The feasible ones form an interval.
+        lo, hi = 1 / (1 + max_overbuild), 1
+        if best_wind_fraction(1 / lo - 1)[1] > target_hours:
+            return None
+        if best_wind_fraction(0)[1] <= target_hours:
+            return solution(hi)
+        while (1 / lo - 1) - (1 / hi - 1) > tolerance:
+            mid = (lo + hi) / 2
+            if best_wind_fraction(1 / mid - 1)[1] <= target_hours:
+                lo = mid
+            else:
+                hi = mid
+        return solution(lo)
+
+    def cheapest(storage_hour_cost, max_overbuild=10):
+        base_fraction, _ = golden_section(
+            lambda b: 1 / b - 1 + storage_hour_cost * best_wind_fraction(1 / b - 1)[1],
+            1 / (1 + max_overbuild), 1, tolerance)
+        return solution(base_fraction)
+
+    storage_hours.best_wind_fraction = best_wind_fraction
+    storage_hours.coarse_error = coarse_error
+    storage_hours.min_overbuild = min_overbuild
+    storage_hours.cheapest = cheapest
+    return storage_hours
+
+# In an interconnected simulation, each region has a link to a shared hub, which can carry this
+# fraction of the region's average demand.  The links between Tesla's four regions carry about
+# 1% of demand today, and their plan roughly triples that.
+INTERCONNECT_CAPACITY = 0.03
+
+def exchange(surplus, link_capacity):
+    '''Moves power between regions through the hub, in each slot.  Regions with a surplus export
+    it and regions with a deficit import, each up to their link capacity, and whichever side has
+    more is scaled back to match the other.  surplus is a (regions, slots) array (MW), and
+    link_capacity broadcasts against it.  Returns the flows (positive for exports).'''
+    exports = np.minimum(np.maximum(surplus, 0), link_capacity)
+    imports = np.minimum(np.maximum(-surplus, 0), link_capacity)
+    total_exports = exports.sum(axis=0)
+    total_imports = imports.sum(axis=0)
+    moved = np.minimum(total_exports, total_imports)
+    exports *= np.divide(moved, total_exports, out=np.zeros_like(moved), where=total_exports > 0)
+    imports *= np.divide(moved, total_imports, out=np.zeros_like(moved), where=total_imports > 0)
+    exports -= imports
+    return exports
+
+def interconnected_terms(basedata, params, slots_per_hour, keep):
+    '''Sizes a region's renewables (as simulate() does) over the given slots.  Returns the
+    (wind, solar, deficit, levelised) terms of its surplus (MW): surplus = (1 + overbuild) *
+    (wind_fraction * wind + (1 - wind_fraction) * solar) + deficit, and the levelised output is
+    (1 + overbuild) * levelised.  The region's historical imports and exports are ignored (its
+    exchanges with the other regions are simulated instead).'''
+    lookahead_slots = params.capacity_planning_lookahead * slots_per_hour
+    isolated = copy.copy(params)
+    isolated.isolate_region = True
+    demand = series(basedata, DEMAND_COL, keep)
+    deficit = nonrenewable_supply(basedata, isolated, keep) - demand
+    max_required = required_capacity(np.maximum(-deficit, 0), params, slots_per_hour)
+    _, wind_cap_factors = capacity_factors(series(basedata, WIND_COL, keep), lookahead_slots)
+    _, solar_cap_factors = capacity_factors(series(basedata, SOLAR_COL, keep), lookahead_slots)
+    wind_dcf, solar_dcf = discount_factors(wind_cap_factors, solar_cap_factors, params)
+    return (max_required * wind_cap_factors / wind_dcf, max_required * solar_cap_factors / solar_dcf,
+            deficit, max_required)
+
+@traced('simulate_interconnected', lambda csvs, *args, **kwargs: {'regions': len(csvs)})
+def simulate_interconnected(csvs, params, slots_per_hour, link_capacity=INTERCONNECT_CAPACITY, quiet=False):
+    '''Simulates several regions (a list of (dates, data, name)) together, with a battery in
+    each region (of params.storage_hours of its own levelised output), and links from each
+    region to a hub (of link_capacity times its average demand).  In each slot, regions trade
+    their surpluses and deficits over the links (see exchange()) before using their batteries,
+    and after the batteries, curtailed power can still cover blackouts elsewhere (over what's
+    left of the links).  The links don't carry stored power.
+
+    Every region gets the same wind fraction and overbuild.  Only slots where every region has
+    data (and enough renewables, see adequate_generation()) are used.  Everything is done on
+    (regions, slots) arrays, so an evaluation costs a few passes over the data.  Returns
+    calc(wind_fraction, overbuild), which returns the (regions, slots) arrays of (storage-hours
+    generated per hour, before the exchange; the same after the exchange; flows (MW); levelised
+    output (MW)).  calc.storage_required(wind_fraction, overbuild, connected=True) returns the
+    storage each region needs (storage-hours), and calc.group_storage() the group's (the
+    regions' storage weighted by their levelised output).'''
+    year_slots = HOURS_PER_YEAR * slots_per_hour
+    names = [name for _, _, name in csvs]
+    aligned, timestamps = align_csv_dates(csvs)
+    present = np.zeros(len(timestamps), dtype=int)
+    for idx, _, _ in aligned:
+        present[idx] += 1
+    common = present == len(csvs)
+    regions = [data[:, common[idx]] for idx, data, _ in aligned]
+    timestamps = timestamps[common]
+    keep = adequate_generation(np.array([series(data, WIND_COL) for data in regions]),
+                               np.array([series(data, SOLAR_COL) for data in regions]), params, slots_per_hour).all(axis=0)
+    if np.count_nonzero(keep) < year_slots * 1.5:
+        print(f'{params.filename}: insufficient renewables datapoints')
+        return None
+    timestamps = timestamps[keep]
+    wind, solar, deficit, levelised = [np.array(t) for t in
+        zip(*[interconnected_terms(data, params, slots_per_hour, keep) for data in regions])]
+    links = link_capacity * np.array([[np.average(series(data, DEMAND_COL, keep))] for data in regions])
+    weights = np.average(levelised, axis=1)
+
+    @traced('calc_interconnected')
+    def calc(wind_fraction, overbuild):
+        surplus = wind_fraction * wind
+        surplus += (1 - wind_fraction) * solar
+        surplus *= 1 + overbuild
+        surplus += deficit
+        flows = exchange(surplus, links)
+        output = levelised * (1 + overbuild)
+        return surplus / output, (surplus - flows) / output, flows, output
+
+    def storage_required(wind_fraction, overbuild, connected=True):
+        walks = np.cumsum(calc(wind_fraction, overbuild)[1 if connected else 0], axis=1)
+        return np.max(np.maximum.accumulate(walks, axis=1) - walks, axis=1) / slots_per_hour
+
+    def group_storage(wind_fraction, overbuild, connected=True):
+        return np.average(storage_required(wind_fraction, overbuild, connected), weights=weights)
+
+    calc.storage_required = storage_required
+    calc.group_storage = group_storage
+    calc.names = names
+    calc.timestamps = timestamps
+    if quiet:
+        return calc
+
+    wind_frac = params.default_wind_fraction
+    if params.optimise_wind_fraction:
+        wind_frac, _ = golden_section(lambda wf: group_storage(wf, params.overbuild), 0, 1, 0.01)
+    supply, connected, flows, output = calc(wind_frac, params.overbuild)
+    isolated_storage = storage_required(wind_frac, params.overbuild, connected=False)
+    connected_storage = storage_required(wind_frac, params.overbuild)
+    # Run the batteries, then let curtailed power cover blackouts over the spare link capacity.
+    _, curtailed, unserved = run_storage(
+        connected, params.storage_hours * slots_per_hour, params.storage_efficiency,
+        params.storage_charge_power, params.storage_discharge_power)
+    rescued = -np.minimum(exchange((curtailed - unserved) * output, links - np.abs(flows)), 0) / output
+    saturated = (links > 0) & (np.abs(flows) >= links * (1 - 1e-9))
+    slots = len(timestamps)
+
+    params.print_parameters()
+    print(f"Interconnected regions: {', '.join(names)} (links: {100 * link_capacity:.1f}% of each region's average demand)")
+    print(f"Wind fraction ({'optimised' if params.optimise_wind_fraction else 'default'}): {wind_frac:.2f}")
+    print(f"Usable datapoints (percent): {100 * slots / len(common):.1f}")
+    print(f"Storage required (storage-hours), blackouts and curtailment (with {params.storage_hours:.1f} storage-hours):")
+    print("                    Isolated  Connected  Blackout %  Unserved %  Curtailed %  Links full %")
+    for i, name in enumerate(names):
+        print(f'{name:18} {isolated_storage[i]:9.1f} {connected_storage[i]:10.1f} '
+              f'{100 * np.count_nonzero(unserved[i] - rescued[i] > 1e-12) / slots:11.3f} '
+              f'{100 * np.sum(unserved[i] - rescued[i]) / slots:11.3f} {100 * np.sum(curtailed[i]) / slots:12.1f} '
+              f'{100 * np.count_nonzero(saturated[i]) / slots:13.1f}')
+    print(f'{"Group":18} {np.average(isolated_storage, weights=weights):9.1f} {np.average(connected_storage, weights=weights):10.1f}')
+    return calc
+
+@traced('get_max_drawdown')
 def get_max_drawdown(walk):
         dd_end = np.argmax(np.maximum.accumulate(walk) - walk)
         dd_start = np.argmax(walk[:dd_end]) if dd_end else dd_end
         max_drawdown = walk[dd_start] - walk[dd_end]
         return max_drawdown, dd_start, dd_end
 
+@traced('enumerate_drawdowns')
+def enumerate_drawdowns(walks, n):
+    '''Finds all the non-overlapping drawdowns (from peak to trough) of at least n in a walk,
+    or in each row of a 2-D array of walks.  Returns arrays of (row, drawdown, start, end,
+    depleted), ordered by row and start, where depleted is the first slot at least n below the
+    peak (when the battery runs dry, if n is the storage).
+
+    Each peak (a new high) starts a period which runs until the next peak, and the deepest
+    trough in each period ends its drawdown.  The recovery from that trough (up to the next
+    peak) is then searched the same way, as though it was a walk of its own.  This finds the
+    same drawdowns as splitting the walk at its biggest drawdown and recursing on either side
+    (as get_drawdowns() used to), but finds all of a walk's periods in one pass, and keeps a
+    list of the recoveries still to search rather than recursing.'''
+    walks = np.asarray(walks)
+    rows = walks[np.newaxis] if walks.ndim == 1 else walks
+    found = []
+    # (row, first slot, end slot) of each walk (or recovery) still to search
+    todo = [(row, 0, rows.shape[1]) for row in range(len(rows)) if rows.shape[1]]
+    while todo:
+        row, first, end = todo.pop()
+        walk = rows[row, first:end]
+        running_max = np.maximum.accumulate(walk)
+        drawdowns = running_max - walk
+        peaks = np.flatnonzero(walk[1:] > running_max[:-1]) + 1
+        max_drawdowns = np.maximum.reduceat(drawdowns, np.append(0, peaks))
+        period_ends = np.append(peaks, len(walk))
+        for p in np.flatnonzero((max_drawdowns >= n) & (max_drawdowns > 0)).tolist():
+            dd_start = peaks[p - 1] if p else 0
+            period = drawdowns[dd_start:period_ends[p]]
+            dd_end = dd_start + np.argmax(period)
+            depleted = dd_start + np.argmax(period >= n) if n > 0 else dd_start
+            found.append((row, first + dd_start, max_drawdowns[p], first + dd_end, first + depleted))
+            if period_ends[p] - dd_end > 1:
+                todo.append((row, first + dd_end, first + period_ends[p]))
+    found.sort(key=lambda f: f[:2])
+    row, starts, drawdowns, ends, depleted = [np.array(col, dtype=dtype) for col, dtype in
+        zip(list(zip(*found)) or [()] * 5, [int, int, walks.dtype, int, int])]
+    return row, drawdowns, starts, ends, depleted
+
 # Get all non-overlapping drawdowns larger than n (from peak to trough).
 def get_drawdowns(walk, n):
-    if walk.shape[0] < 1:
-        return []
-    max_drawdown, dd_start, dd_end = get_max_drawdown(walk)
-    if max_drawdown < n or dd_end < 1:
-        return []
-    ls = get_drawdowns(walk[:dd_start], n) if dd_start > 0 else []
-    ls.append((max_drawdown, dd_start, dd_end))
-    rs = get_drawdowns(walk[dd_end:], n) if dd_end+1 < walk.shape[0] else []
-    return ls + list(map(lambda m: (m[0], m[1]+dd_end, m[2]+dd_end), rs))
+    _, drawdowns, starts, ends, _ = enumerate_drawdowns(walk, n)
+    return list(zip(drawdowns, starts, ends))
+
+# A drawdown_index() node summarises a range of a walk as (max, where, min, where, max drawdown,
+# start, end), with the first of any ties, as get_max_drawdown() picks them.  These are
+# numpy arrays (of nodes); an empty range has max -inf, min +inf and drawdown -inf.
 
+def empty_drawdown_nodes(count):
+    '''count nodes for empty ranges'''
+    zeros = np.zeros(count, dtype=int)
+    return (np.full(count, -np.inf), zeros, np.full(count, np.inf), zeros, np.full(count, -np.inf), zeros, zeros)
+
+def merge_drawdown_nodes(walk, a, b):
+    '''The nodes for ranges a followed by b (each an array of nodes)'''
+    a_max, a_max_at, a_min, a_min_at, a_dd, a_start, a_end = a
+    b_max, b_max_at, b_min, b_min_at, b_dd, b_start, b_end = b
+    # The biggest drawdown ending in b is either b's own, or from a's peak to b's trough
+    # (whichever ends first, if they're the same).  b's own starts at a's peak if that's as high.
+    cross = a_max - b_min
+    own = (b_dd > cross) | ((b_dd == cross) & (b_end < b_min_at))
+    b_dd = np.where(own, b_dd, cross)
+    b_start = np.where(own & (walk[b_start] > a_max), b_start, a_max_at)
+    b_end = np.where(own, b_end, b_min_at)
+    first = a_dd >= b_dd
+    return (np.maximum(a_max, b_max), np.where(a_max >= b_max, a_max_at, b_max_at),
+            np.minimum(a_min, b_min), np.where(a_min <= b_min, a_min_at, b_min_at),
+            np.where(first, a_dd, b_dd), np.where(first, a_start, b_start), np.where(first, a_end, b_end))
+
+@traced('drawdown_index')
+def drawdown_index(walk):
+    '''Returns a function max_drawdown(start, end) giving get_max_drawdown(walk[start:end]),
+    with the slots relative to the whole walk, in O(log(len(walk))) time.  It's a segment tree:
+    each level summarises pairs of the nodes below it (see merge_drawdown_nodes()), so any
+    range is covered by at most two nodes per level.  It takes about seven times the walk's
+    memory.  Has attached:
+
+    batch(starts, ends) -> (drawdowns, starts, ends)
+        Looks up arrays of ranges at once (a level at a time, for all of them).
+    periods(timestamps, kinds=('year', 'season', 'month')) -> [(kind, label, drawdown, start, end)]
+        The biggest drawdown in each calendar period the (sorted) timestamps of the walk's
+        slots cover (see calendar_periods()).'''
+    walk = np.asarray(walk, dtype=float)
+    slots = np.arange(len(walk))
+    # The walk's slots are the bottom level (made when needed).
+    levels = [None]
+    nodes = (walk, slots, walk, slots, np.zeros(len(walk)), slots, slots)
+    while len(nodes[0]) > 1:
+        if len(nodes[0]) % 2:
+            nodes = tuple(np.concatenate((n, e)) for n, e in zip(nodes, empty_drawdown_nodes(1)))
+        nodes = merge_drawdown_nodes(walk, tuple(n[0::2] for n in nodes), tuple(n[1::2] for n in nodes))
+        levels.append(nodes)
+
+    def level_nodes(level, at):
+        if level:
+            return tuple(n[at] for n in levels[level])
+        return (walk[at], at, walk[at], at, np.zeros(len(at)), at, at)
+
+    def batch(starts, ends):
+        lo, hi = np.array(starts, dtype=int), np.array(ends, dtype=int)
+        if np.any((lo < 0) | (lo >= hi) | (hi > len(walk))):
+            raise ValueError('Drawdown ranges must be non-empty slices of the walk')
+        left, right = empty_drawdown_nodes(len(lo)), empty_drawdown_nodes(len(lo))
+        level = 0
+        while np.any(lo < hi):
+            # A range starting (or ending) halfway through a node takes the half it needs, and
+            # carries on from the next node up.
+            take = (lo < hi) & (lo % 2 == 1)
+            merged = merge_drawdown_nodes(walk, left, level_nodes(level, np.where(take, lo, 0)))
+            left = tuple(np.where(take, m, n) for m, n in zip(merged, left))
+            lo += take
+            take = (lo < hi) & (hi % 2 == 1)
+            hi -= take
+            merged = merge_drawdown_nodes(walk, level_nodes(level, np.where(take, hi, 0)), right)
+            right = tuple(np.where(take, m, n) for m, n in zip(merged, right))
+            lo //= 2
+            hi //= 2
+            level += 1
+        _, _, _, _, drawdowns, starts, ends = merge_drawdown_nodes(walk, left, right)
+        return drawdowns, starts, ends
+
+    def max_drawdown(start, end):
+        drawdowns, starts, ends = batch([start], [end])
+        return drawdowns[0], starts[0], ends[0]
+
+    def periods(timestamps, kinds=('year', 'season', 'month')):
+        found = calendar_periods(timestamps, kinds)
+        if not found:
+            return []
+        kinds, labels, starts, ends = zip(*found)
+        drawdowns, starts, ends = batch(starts, ends)
+        return list(zip(kinds, labels, drawdowns.tolist(), starts.tolist(), ends.tolist()))
+
+    max_drawdown.batch = batch
+    max_drawdown.periods = periods
+    return max_drawdown
+
+SEASONS = ['winter', 'spring', 'summer', 'autumn']
+
+# The periods calendar_periods() knows, as (the period a month (counted from January 1970) is
+# in, the period's label).
+CALENDAR_PERIODS = {
+    'year': (lambda m: m // 12, lambda k: f'{1970 + k}'),
+    'season': (lambda m: (m + 1) // 3, lambda k: f'{1970 + k // 4} {SEASONS[k % 4]}'),
+    'month': (lambda m: m, lambda k: f'{1970 + k // 12}-{k % 12 + 1:02}'),
+}
+
+def calendar_periods(timestamps, kinds=('year', 'season', 'month')):
+    '''Splits (sorted) timestamps into calendar years, seasons (winter being December to
+    February, counted in the year its January is in) and months.  Returns a list of (kind,
+    label, start, end), where timestamps[start:end] is the period.'''
+    months = parse_timestamps(timestamps).astype('datetime64[M]').astype(int)
+    if not len(months):
+        return []
+    # Each period is a run of months, so we only need where the months end.
+    month_ends = np.concatenate((np.flatnonzero(months[1:] != months[:-1]) + 1, [len(months)]))
+    months = months[month_ends - 1]
+    month_starts = np.concatenate(([0], month_ends[:-1]))
+    found = []
+    for kind in kinds:
+        period, label = CALENDAR_PERIODS[kind]
+        keys = period(months)
+        firsts = np.concatenate(([0], np.flatnonzero(keys[1:] != keys[:-1]) + 1))
+        lasts = np.concatenate((firsts[1:], [len(keys)])) - 1
+        found += [(kind, label(int(k)), int(s), int(e)) for k, s, e in zip(keys[firsts], month_starts[firsts], month_ends[lasts])]
+    return found
 
 def trailing_sma(vec, window):
-    '''Returns a trailing rolling average of a vector, with the initial values
-    the mean of all preceding values'''
-    cs = np.cumsum(vec)
-    cs[window:] = (cs[window:] - cs[:-window]) / window
-    cs[:window] /= np.arange(1, window+1)
-    return cs
+    '''Returns a trailing rolling average of a vector (or of each row of an array), with the
+    initial values the mean of all preceding values'''
+    sums = rolling_sums(vec, window)
+    out = np.empty(np.shape(vec))
+    out[..., :window] = np.cumsum(vec[..., :window], axis=-1, dtype=float) / np.arange(1, min(window, out.shape[-1]) + 1)
+    np.divide(sums[..., 1:], window, out=out[..., window:])
+    return out
 
+@traced('centered_sma')
 def centered_sma(vec, lookahead, season_len=None):
-    '''Returns a centered rolling average of a vector, with the initial and final values filled
-    in with those from the following or preceding season'''
+    '''Returns a centered rolling average of a vector (or of each row of an array), with the
+    initial and final values filled in with those from the following or preceding season'''
     if not season_len:
         season_len = lookahead
     icols = lookahead // 2
     fcols = lookahead - icols
-    cs = np.cumsum(vec)
-    cs[icols:-fcols] = (cs[lookahead:] - cs[:-lookahead]) / lookahead
-    cs[:icols] = cs[season_len:season_len + icols]
-    cs[-fcols:] = cs[-fcols-season_len:-season_len]
-    return cs
+    sums = rolling_sums(vec, lookahead)
+    slots = np.shape(vec)[-1]
+    out = np.empty(np.shape(vec))
+    np.divide(sums[..., 1:], lookahead, out=out[..., icols:-fcols])
+    # The season before or after is clamped to the averages we've worked out (the series can be
+    # shorter than lookahead + season_len, and the rest of out isn't filled in yet).
+    out[..., :icols] = out[..., np.minimum(np.arange(season_len, season_len + icols), slots - fcols - 1)]
+    out[..., -fcols:] = out[..., np.maximum(np.arange(slots - fcols - season_len, slots - season_len), icols)]
+    return out
 
 # The EIA spreadsheet column headers.
 DEMAND_COL, EXPORT_COL, TOTAL_GEN_COL, FIRST_GEN_COL, WIND_COL, SOLAR_COL, NUCLEAR_COL, HYDRO_COL = 0, 1, 2, 3, 3, 4, 5, 6
@@ -396,18 +1578,24 @@ gridwatch_col_map = {
     }
 gridwatch_cols = [ gridwatch_col_map[i] for i in eia_cols ]
 gridwatch_timestamp = 'timestamp'
+# Readings beyond this (in MW) are glitches, like the -6e34 interconnect value in Jan 2018.
+# The readings are dropped as the CSV is loaded.
+GRIDWATCH_SPIKE_LIMIT = 1e6
+# The gridwatch data has a reading every 5 minutes (12 slots per hour).  Set this to resample
+# it as it's loaded (eg: 1 for hourly, which needs a twelfth of the memory).
+GRIDWATCH_SLOTS_PER_HOUR = None
 
 # A column def can be "a+b-c-d", in which case that output column
 # will be the sum/difference of those input fields.
-def load_csv(fname, data_col_defs, timestamp_col, delimiter='|', start_year=None):
-    '''Load a CSV, returning a list of dates and an array of generation data'''
+def parse_col_defs(data_col_defs):
+    '''Returns the list of input fields used by the column defs, and the matrix of
+    signs which maps the input fields to the output columns.'''
     data_cols = []
-    col_map = {}
+    signs = []
     def add_col(i, name, sign):
-        if name not in col_map:
-            col_map[name] = (len(data_cols), [])
+        if name not in data_cols:
             data_cols.append(name)
-        col_map[name][1].append((i, sign))
+        signs.append((i, data_cols.index(name), sign))
 
     for i, col in enumerate(data_col_defs):
         for pos in col.split('+'):
@@ -419,73 +1607,506 @@ def load_csv(fname, data_col_defs, timestamp_col, delimiter='|', start_year=None
                 if neg:
                     add_col(i, neg, -1)
 
-    with open(fname, newline='') as datfile:
-        datreader = csv.reader(datfile, delimiter=delimiter, quotechar='"', quoting=csv.QUOTE_MINIMAL)
+    sign_matrix = np.zeros((len(data_col_defs), len(data_cols)))
+    for ocol, icol, sign in signs:
+        sign_matrix[ocol, icol] += sign
+    # The final input field has always been ignored (for EIA data that's 'NG: UNK').  Keep
+    # it that way, so that results don't change.
+    if data_cols:
+        sign_matrix[:, -1] = 0
+    return data_cols, sign_matrix
+
+# We parse CSVs this many bytes at a time.
+CSV_CHUNK_BYTES = 1 << 22
+
+def fill_empty_fields(text, delimiter):
+    '''Replaces empty fields with zeros, as numpy can't parse them'''
+    d = delimiter
+    text = f'\n{text}\n'.replace(d + d, d + '0' + d).replace(d + d, d + '0' + d)
+    return text.replace(d + '\n', d + '0\n').replace('\n' + d, '\n0' + d)[1:-1]
+
+def fill_blank_fields(text, delimiter):
+    '''Replaces empty or whitespace-only fields with zeros (slower than fill_empty_fields)'''
+    d = re.escape(delimiter)
+    text = re.sub(f'{d}[ \\t]*(?=[{d}\\n]|$)', lambda m: delimiter + '0', text)
+    return re.sub(f'(?m)^[ \\t]*(?={d})', '0', text)
+
+def parse_csv_chunk(lines, delimiter, indices):
+    '''Parses the given fields of a list of CSV lines into a (lines, fields) array'''
+    opts = dict(delimiter=delimiter, quotechar='"', comments=None, usecols=indices, ndmin=2)
+    try:
+        return np.loadtxt(lines, **opts)
+    except ValueError:
+        pass
+    # Most likely empty fields.  Filling them in is slow, so we only do it when we have to.
+    text = ''.join(lines)
+    try:
+        return np.loadtxt(fill_empty_fields(text, delimiter).splitlines(), **opts)
+    except ValueError:
+        return np.loadtxt(fill_blank_fields(text, delimiter).splitlines(), **opts)
+
+# Timestamps are parsed into datetime64 (seconds since the epoch) arrays as they are loaded,
+# and are only turned back into strings for printing.
+def parse_timestamps(dates):
+    '''Converts an array of 'YYYY-MM-DD HH:MM:SS' strings (or of datetimes) to datetime64[s]'''
+    return np.asarray(dates).astype('datetime64[s]')
+
+def format_timestamps(timestamps):
+    '''Formats an array of timestamps as 'YYYY-MM-DD HH:MM:SS' strings'''
+    strings = np.datetime_as_string(timestamps, unit='s')
+    return np.char.replace(strings, 'T', ' ') if strings.size else strings # (replace() fails on empty arrays)
+
+def format_timestamp(timestamp):
+    return str(format_timestamps(timestamp))
+
+def read_csv_chunks(fname, fields, timestamp_col, delimiter, offset=None):
+    '''Yields (timestamps, values) chunks from a CSV, where values is a (rows, fields) array.
+    If offset is given, the lines from that byte offset on are read (see append_cache()).'''
+    with open(fname) as datfile:
+        datreader = csv.reader([datfile.readline()], delimiter=delimiter, quotechar='"', quoting=csv.QUOTE_MINIMAL)
         headers = list(datreader.__next__())
         headers = [ h.strip() for h in headers ]
-        indices = [ headers.index(n) for n in data_cols + [ timestamp_col ] ]
-        dates = []
-        rows = []
-        for rec in datreader:
-            nr = [ rec[i].strip() for i in indices ]
-            cr = [ 0 ] * len(data_col_defs)
-            for i, name in enumerate(data_cols[:-1]):
-                if nr[i]:
-                    for ocol, sign in col_map[name][1]:
-                        cr[ocol] += float(nr[i]) * sign
-            if start_year is not None:
-                if int(nr[-1].split('-')[0]) < start_year:
+        indices = [ headers.index(n) for n in fields ]
+        ts_index = headers.index(timestamp_col)
+        if offset:
+            datfile.seek(offset)
+        while lines := datfile.readlines(CSV_CHUNK_BYTES):
+            chunk_dates = np.char.strip(np.loadtxt(lines, dtype=str, delimiter=delimiter, quotechar='"',
+                                                   comments=None, usecols=[ts_index], ndmin=1))
+            yield parse_timestamps(chunk_dates), parse_csv_chunk(lines, delimiter, indices)
+
+def year_mask(dates, start_year):
+    '''Which of an array of timestamps fall in or after start_year'''
+    return dates >= np.datetime64(f'{start_year:04}-01-01', 's')
+
+def load_records(reader, data_col_defs, spike_limit=None):
+    '''Applies the column defs to the chunks from reader(fields), yielding (dates, data)
+    chunks, where data is a (columns, rows) array.  Rows with any field beyond +/-spike_limit
+    are dropped.'''
+    data_cols, sign_matrix = parse_col_defs(data_col_defs)
+    used_fields = np.any(sign_matrix != 0, axis=0)
+    for chunk_dates, values in reader(data_cols):
+        chunk = sign_matrix @ values.T
+        # ignore rows for which the generation mix is empty (no disaggregated data before 2018).
+        keep = np.any(chunk[FIRST_GEN_COL:] != 0, axis=0)
+        if spike_limit is not None:
+            keep &= np.all(np.abs(values[:, used_fields]) <= spike_limit, axis=1)
+        yield chunk_dates[keep], chunk[:, keep]
+
+def load_chunks(reader, data_col_defs, start_year=None):
+    '''Applies the column defs to the chunks from reader(fields), returning an array of
+    timestamps and an array of generation data'''
+    dates = []
+    chunks = []
+    for chunk_dates, chunk in load_records(reader, data_col_defs):
+        if start_year is not None:
+            keep = year_mask(chunk_dates, start_year)
+            chunk_dates, chunk = chunk_dates[keep], chunk[:, keep]
+        dates.append(chunk_dates)
+        chunks.append(chunk)
+
+    if not chunks:
+        return np.zeros(0, dtype='datetime64[s]'), np.zeros((len(data_col_defs), 0))
+    return np.concatenate(dates), np.concatenate(chunks, axis=1)
+
+@traced('load_csv', lambda fname, *args, **kwargs: {'file': fname})
+def load_csv(fname, data_col_defs, timestamp_col, delimiter='|', start_year=None):
+    '''Load a CSV, returning an array of timestamps and an array of generation data'''
+    return load_chunks(lambda fields: read_csv_chunks(fname, fields, timestamp_col, delimiter),
+                       data_col_defs, start_year)
+
+def resample_records(records, slots_per_hour):
+    '''Averages (timestamps, data) chunks (in time order) into slots_per_hour slots per hour.
+    Each slot is dated by its start.  Slots with no readings are left out (as gaps are
+    elsewhere).'''
+    slot_seconds = 3600 // slots_per_hour
+    def slot_numbers(dates):
+        return dates.astype(np.int64) // slot_seconds
+    def averages(dates, data):
+        slots = slot_numbers(dates)
+        starts = np.flatnonzero(np.diff(slots, prepend=slots[0] - 1))
+        return ((slots[starts] * slot_seconds).astype('datetime64[s]'),
+                np.add.reduceat(data, starts, axis=1) / np.diff(starts, append=len(slots)))
+
+    held_dates = held = None
+    for dates, data in records:
+        if held_dates is not None:
+            dates, data = np.concatenate((held_dates, dates)), np.concatenate((held, data), axis=1)
+        if not len(dates):
+            continue
+        # The last slot may continue into the next chunk, so we hold it back.
+        slots = slot_numbers(dates)
+        last = np.flatnonzero(slots != slots[-1])
+        last = last[-1] + 1 if len(last) else 0
+        if last:
+            yield averages(dates[:last], data[:, :last])
+        held_dates, held = dates[last:], data[:, last:]
+    if held_dates is not None and len(held_dates):
+        yield averages(held_dates, held)
+
+def count_lines(fname):
+    '''Counts the lines in a file (quickly)'''
+    lines = 0
+    with open(fname, 'rb') as f:
+        while block := f.read(CSV_CHUNK_BYTES):
+            lines += block.count(b'\n')
+    return lines + 1
+
+def write_records(records, max_rows, columns, entry=None):
+    '''Writes (timestamps, data) chunks into preallocated arrays of max_rows, returning the
+    (timestamps, data) arrays.  If we have a cache entry, the arrays are memory-mapped files in the
+    entry, so we never hold all the data in memory.'''
+    def fill(dates, data):
+        rows = 0
+        for chunk_dates, chunk in records:
+            dates[rows:rows + len(chunk_dates)] = chunk_dates
+            data[:, rows:rows + len(chunk_dates)] = chunk
+            rows += len(chunk_dates)
+        return rows
+    if entry is None:
+        dates, data = np.empty(max_rows, dtype='datetime64[s]'), np.empty((columns, max_rows), dtype=float)
+        rows = fill(dates, data)
+        return dates[:rows], data[:, :rows]
+    try:
+        dates = np.lib.format.open_memmap(f'{entry}.0.npy.part', mode='w+', dtype='datetime64[s]', shape=(max_rows,))
+        data = np.lib.format.open_memmap(f'{entry}.1.npy.part', mode='w+', dtype=float, shape=(columns, max_rows))
+        rows = fill(dates, data)
+        # Copy to files of the right size, a block of slots at a time.
+        for i, arr in enumerate([dates, data]):
+            out = np.lib.format.open_memmap(f'{entry}.{i}.npy.tmp', mode='w+', dtype=arr.dtype, shape=arr.shape[:-1] + (rows,))
+            for start in range(0, rows, 1 << 16):
+                end = min(start + (1 << 16), rows)
+                out[..., start:end] = arr[..., start:end]
+            out.flush()
+            del out
+            os.replace(f'{entry}.{i}.npy.tmp', f'{entry}.{i}.npy')
+    finally:
+        # The preallocated files (and any part-written copy, if loading failed) are left
+        # behind otherwise, at the size of the whole file.
+        for i in range(2):
+            for suffix in ('part', 'tmp'):
+                if os.path.exists(f'{entry}.{i}.npy.{suffix}'):
+                    os.remove(f'{entry}.{i}.npy.{suffix}')
+    return tuple(np.load(f'{entry}.{i}.npy', mmap_mode='r') for i in range(2))
+
+@traced('stream_load', lambda fname, *args, **kwargs: {'file': fname})
+def stream_load(fname, data_col_defs, timestamp_col, delimiter=',', slots_per_hour=None, spike_limit=None, start_year=None):
+    '''Like cached_load() for a CSV, but streams it into preallocated arrays (memory-mapped
+    cache files, unless caching is off), dropping spikes (see load_records()) and resampling to
+    slots_per_hour (if given) as it goes.  Memory use doesn't grow with the size of the file.'''
+    name, key = data_cache_key(fname, data_col_defs, timestamp_col, delimiter)
+    key += (slots_per_hour, spike_limit)
+    entry = cache_entry(name, key) if CACHE_DIR else None
+    arrays = read_cache(entry, [fname]) if entry else None
+    if arrays is None:
+        stamp = source_stamp([fname])
+        records = load_records(lambda fields: read_csv_chunks(fname, fields, timestamp_col, delimiter),
+                               data_col_defs, spike_limit)
+        if slots_per_hour:
+            records = resample_records(records, slots_per_hour)
+        if entry:
+            os.makedirs(CACHE_DIR, exist_ok=True)
+        arrays = write_records(records, count_lines(fname), len(data_col_defs), entry)
+        if entry:
+            write_cache_entry_meta(entry, key, [fname], len(arrays), stamp)
+    dates, data = arrays
+    if start_year is not None:
+        keep = year_mask(dates, start_year)
+        dates, data = dates[keep], data[:, keep]
+    return dates, data
+
+# We don't need a spreadsheet library to read the EIA workbooks: an xlsx file is a zip of
+# XML files, and we only want the values from the first sheet.
+XLSX_NS = '{http://schemas.openxmlformats.org/spreadsheetml/2006/main}'
+XLSX_REL_NS = '{http://schemas.openxmlformats.org/officeDocument/2006/relationships}'
+XLSX_CHUNK_ROWS = 1 << 16
+
+def xlsx_first_sheet(zf):
+    '''Returns the path (within the zip) of the first worksheet'''
+    sheet = ET.fromstring(zf.read('xl/workbook.xml')).find(f'{XLSX_NS}sheets/{XLSX_NS}sheet')
+    for rel in ET.fromstring(zf.read('xl/_rels/workbook.xml.rels')):
+        if rel.get('Id') == sheet.get(f'{XLSX_REL_NS}id'):
+            target = rel.get('Target')
+            return target[1:] if target.startswith('/') else f'xl/{target}'
+    raise Exception(f'No worksheet found in {zf.filename}')
+
+def xlsx_shared_strings(zf):
+    '''Returns the workbook's table of shared strings'''
+    if 'xl/sharedStrings.xml' not in zf.namelist():
+        return []
+    strings = []
+    with zf.open('xl/sharedStrings.xml') as f:
+        for _, elem in ET.iterparse(f):
+            if elem.tag == f'{XLSX_NS}si':
+                strings.append(''.join(t.text or '' for t in elem.iter(f'{XLSX_NS}t')))
+                elem.clear()
+    return strings
+
+def xlsx_rows(fname):
+    '''Streams the rows of the first sheet of an xlsx file, as {column: value} dicts.
+    Values are strings or floats (which is how dates are stored).'''
+    with zipfile.ZipFile(fname) as zf:
+        strings = xlsx_shared_strings(zf)
+        with zf.open(xlsx_first_sheet(zf)) as f:
+            sheet_data = None
+            for event, row in ET.iterparse(f, events=('start', 'end')):
+                if event == 'start':
+                    if row.tag == f'{XLSX_NS}sheetData':
+                        sheet_data = row
+                    continue
+                if row.tag != f'{XLSX_NS}row':
                     continue
-            # ignore rows for which the generation mix is empty (no disaggregated data before 2018).
-            if not any(cr[FIRST_GEN_COL:]):
-                continue
-            dates.append(nr[-1])
-            rows.append(cr)
+                cells = {}
+                col = -1
+                for c in row.iter(f'{XLSX_NS}c'):
+                    ref = c.get('r')
+                    if ref:
+                        col = 0
+                        for ch in ref.rstrip('0123456789'):
+                            col = col * 26 + ord(ch) - ord('A') + 1
+                        col -= 1
+                    else:
+                        col += 1
+                    ctype = c.get('t')
+                    if ctype == 'inlineStr':
+                        cells[col] = ''.join(t.text or '' for t in c.iter(f'{XLSX_NS}t'))
+                        continue
+                    v = c.find(f'{XLSX_NS}v')
+                    if v is None or v.text is None:
+                        continue
+                    if ctype == 's':
+                        cells[col] = strings[int(v.text)]
+                    elif ctype in ('str', 'e'):
+                        cells[col] = v.text
+                    else:
+                        cells[col] = float(v.text)
+                sheet_data.clear() # we've finished with the row
+                if cells:
+                    yield cells
+
+def xlsx_dates(values):
+    '''Converts a list of xlsx date cells (day numbers, or strings, or a mix of the two) to
+    timestamps'''
+    numbers = np.array([isinstance(v, float) for v in values], dtype=bool)
+    days = np.array([v for v in values if isinstance(v, float)], dtype=float)
+    timestamps = np.empty(len(values), dtype='datetime64[s]')
+    timestamps[numbers] = np.datetime64('1899-12-30', 's') + np.rint(days * 86400).astype('timedelta64[s]')
+    if not numbers.all():
+        timestamps[~numbers] = parse_timestamps(np.char.strip(np.array([v for v in values if not isinstance(v, float)], dtype=str)))
+    return timestamps
+
+def read_xlsx_chunks(fname, fields, timestamp_col):
+    '''Yields (timestamps, values) chunks from the first sheet of an xlsx file, where values is a
+    (rows, fields) array'''
+    def number(v):
+        return float(v.strip() or 0) if isinstance(v, str) else v
+    rows = xlsx_rows(fname)
+    headers = next(rows, {})
+    headers = { str(h).strip(): i for i, h in headers.items() }
+    indices = [ headers[n] for n in fields ]
+    ts_index = headers[timestamp_col]
+    while True:
+        chunk = list(itertools.islice(rows, XLSX_CHUNK_ROWS))
+        if not chunk:
+            return
+        chunk = [r for r in chunk if ts_index in r]
+        values = np.array([[number(r.get(i, 0)) for i in indices] for r in chunk], dtype=float)
+        yield xlsx_dates([r[ts_index] for r in chunk]), values.reshape(len(chunk), len(indices))
+
+@traced('load_xlsx', lambda fname, *args, **kwargs: {'file': fname})
+def load_xlsx(fname, data_col_defs, timestamp_col, start_year=None):
+    '''Load the first sheet of an xlsx file, returning an array of timestamps and an array of
+    generation data'''
+    return load_chunks(lambda fields: read_xlsx_chunks(fname, fields, timestamp_col),
+                       data_col_defs, start_year)
+
+def source_stamp(fnames):
+    '''The (size, mtime) of each source file - a cache entry is stale if these change'''
+    return [[os.stat(fn).st_size, os.stat(fn).st_mtime_ns] for fn in fnames]
+
+def source_digest(fnames):
+    '''A hash of the contents of the source files'''
+    h = hashlib.sha1()
+    for fn in fnames:
+        with open(fn, 'rb') as f:
+            while block := f.read(1 << 24):
+                h.update(block)
+    return h.hexdigest()
+
+def save_npy(fname, arr):
+    '''Write an array, atomically (so an interrupted run can't leave a corrupt cache)'''
+    with open(f'{fname}.tmp', 'wb') as f:
+        np.save(f, arr)
+    os.replace(f'{fname}.tmp', fname)
+
+def cache_entry(name, key):
+    '''The path prefix of a cache entry: `name` plus a hash of `key`'''
+    return f'{CACHE_DIR}/{name}-{hashlib.sha1(repr(key).encode()).hexdigest()[:16]}'
 
-    cols = list(zip(*rows)) # transpose
-    return dates, np.array(cols, dtype=float)
+def write_cache_meta(entry, meta):
+    with open(f'{entry}.json.tmp', 'w') as f:
+        json.dump(meta, f)
+    os.replace(f'{entry}.json.tmp', f'{entry}.json')
+
+def read_cache(entry, sources):
+    '''Returns a cache entry's arrays (read-only and memory-mapped), or None if the entry is
+    missing or stale.  If the sources have been touched, but their contents haven't changed
+    (eg: they were downloaded again), the entry is still good.'''
+    try:
+        with open(f'{entry}.json') as f:
+            meta = json.load(f)
+        stamp = source_stamp(sources)
+        if meta['sources'] != stamp:
+            if meta['digest'] != source_digest(sources):
+                return None
+            meta['sources'] = stamp
+            write_cache_meta(entry, meta)
+        return tuple(np.load(f'{entry}.{i}.npy', mmap_mode='r') for i in range(meta['arrays']))
+    except (OSError, ValueError, KeyError):
+        return None
+
+def write_cache_entry_meta(entry, key, sources, count, stamp=None):
+    '''Marks a cache entry (with `count` arrays, already written) as complete'''
+    if stamp is None:
+        stamp = source_stamp(sources)
+    write_cache_meta(entry, {'key': repr(key), 'sources': stamp, 'digest': source_digest(sources), 'arrays': count,
+                             'tails': [tail_digest(fn, size) for fn, (size, _) in zip(sources, stamp)]})
+
+def write_cache(entry, key, sources, arrays, stamp=None):
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    if stamp is None:
+        stamp = source_stamp(sources)
+    for i, arr in enumerate(arrays):
+        save_npy(f'{entry}.{i}.npy', np.asarray(arr))
+    # The metadata goes last: it marks the entry as complete.
+    write_cache_entry_meta(entry, key, sources, len(arrays), stamp)
+
+# The EIA files grow by an hour at a time.  If the end of what we read last time is unchanged
+# (this much of it is checked), the cached arrays are extended with just the new rows.
+APPEND_CHECK_BYTES = 1 << 16
+
+def tail_digest(fname, size):
+    '''A hash of the APPEND_CHECK_BYTES of a file before `size`'''
+    with open(fname, 'rb') as f:
+        f.seek(max(size - APPEND_CHECK_BYTES, 0))
+        return hashlib.sha1(f.read(min(size, APPEND_CHECK_BYTES))).hexdigest()
+
+def append_cache(entry, key, sources, append):
+    '''Brings a stale cache entry up to date, if its sources have only grown: append(arrays,
+    sizes) is given the entry's arrays and the sizes the sources were when it was written, and
+    returns the arrays to add to them (along their last axis), or None if it can't.  Returns
+    the updated arrays, or None.'''
+    try:
+        with open(f'{entry}.json') as f:
+            meta = json.load(f)
+        stamp = source_stamp(sources)
+        sizes = [size for size, _ in meta['sources']]
+        if any(size >= new_size for size, (new_size, _) in zip(sizes, stamp)):
+            return None
+        if meta['tails'] != [tail_digest(fn, size) for fn, size in zip(sources, sizes)]:
+            return None
+        arrays = tuple(np.load(f'{entry}.{i}.npy', mmap_mode='r') for i in range(meta['arrays']))
+        added = append(arrays, sizes)
+    except (OSError, ValueError, KeyError):
+        return None
+    if added is None:
+        return None
+    arrays = tuple(np.concatenate((arr, new), axis=-1) for arr, new in zip(arrays, added))
+    write_cache(entry, key, sources, arrays, stamp)
+    return arrays
+
+def cached_arrays(name, key, sources, load, append=None):
+    '''Returns load() - a tuple of arrays - via the cache.  Entries are identified by
+    `name` plus a hash of `key`, and are rebuilt if any of the `sources` files change (or
+    extended, if they have grown, and `append` is given - see append_cache()).'''
+    if not CACHE_DIR:
+        return load()
+    entry = cache_entry(name, key)
+    arrays = read_cache(entry, sources)
+    if arrays is None and append is not None:
+        arrays = append_cache(entry, key, sources, append)
+    if arrays is None:
+        arrays = load()
+        write_cache(entry, key, sources, arrays)
+    return arrays
+
+# Bump this when the arrays we cache change (so old entries aren't used).  2: timestamps are datetime64.
+CACHE_FORMAT = 2
+
+def data_cache_key(fname, data_col_defs, timestamp_col, delimiter):
+    return os.path.basename(fname), (os.path.abspath(fname), data_col_defs, timestamp_col, delimiter, CACHE_FORMAT)
+
+def cached_load(fname, data_col_defs, timestamp_col, delimiter='|', start_year=None):
+    '''load_csv() (or load_xlsx(), for .xlsx files), via the cache'''
+    def load():
+        if fname.endswith('.xlsx'):
+            return load_xlsx(fname, data_col_defs, timestamp_col)
+        return load_csv(fname, data_col_defs, timestamp_col, delimiter=delimiter)
+    def append(arrays, sizes):
+        # Only whole lines can be appended to, and the new rows must come after the old ones.
+        with open(fname, 'rb') as f:
+            f.seek(sizes[0] - 1)
+            if fname.endswith('.xlsx') or f.read(1) != b'\n':
+                return None
+        new_dates, new_data = load_chunks(
+            lambda fields: read_csv_chunks(fname, fields, timestamp_col, delimiter, sizes[0]), data_col_defs)
+        if len(arrays[0]) and len(new_dates) and new_dates[0] <= arrays[0][-1]:
+            return None
+        return new_dates, new_data
+    # We cache all the data, and apply start_year afterwards (so the entry can be shared).
+    dates, data = cached_arrays(*data_cache_key(fname, data_col_defs, timestamp_col, delimiter), [fname], load, append)
+    if start_year is not None:
+        keep = year_mask(dates, start_year)
+        dates, data = dates[keep], data[:, keep]
+    return dates, data
 
 def eia_csv_loader(start_year=None):
     def load_eia_csv(fname):
-        '''Load an EIA CSV, returning (dates, data, fname)'''
-        dates, data = load_csv(fname, eia_cols, eia_timestamp, delimiter='|', start_year=start_year)
+        '''Load an EIA CSV (or xlsx), returning (dates, data, fname)'''
+        dates, data = cached_load(fname, eia_cols, eia_timestamp, delimiter='|', start_year=start_year)
         return dates, data, fname
     return load_eia_csv
 
-def gridwatch_csv_loader(start_year=None):
+def gridwatch_csv_loader(start_year=None, slots_per_hour=None):
     def load_gridwatch_csv(fname):
         '''Load a gridwatch CSV, returning (dates, data, fname)'''
-        dates, data = load_csv(fname, gridwatch_cols, gridwatch_timestamp, delimiter=',', start_year=start_year)
+        dates, data = stream_load(fname, gridwatch_cols, gridwatch_timestamp, delimiter=',', slots_per_hour=slots_per_hour,
+                                  spike_limit=GRIDWATCH_SPIKE_LIMIT, start_year=start_year)
         return dates, data, fname
     return load_gridwatch_csv
 
+def extract_eia_xlsx(fname):
+    '''Loads an EIA xlsx file into the cache, unless it's already there'''
+    entry = cache_entry(*data_cache_key(fname, eia_cols, eia_timestamp, '|'))
+    if read_cache(entry, [fname]) is not None:
+        return f'{fname}: unchanged'
+    dates, data, _ = eia_csv_loader()(fname)
+    return f'{fname}: {len(dates)} records'
+
+def extract_all_eia_xlsx(dir=EIA_DATA_DIR, processes=None):
+    '''Extract all the downloaded EIA workbooks into the cache, in parallel'''
+    fnames = [f'{dir}/{i}' for i in sorted(os.listdir(dir)) if i.endswith('.xlsx')]
+    with multiprocessing.Pool(processes) as pool:
+        for status in pool.imap(extract_eia_xlsx, fnames):
+            print(status)
+
 # Alignment only matters for 2018 EIA data (reporting from different timezones
 # started at different GMT times on Jul 1 2018).
+@traced('align_csv_dates', lambda csvs: {'csvs': len(csvs)})
 def align_csv_dates(csvs):
-    '''Sequence-align the timestamps across all CSVs, then assign indices to them.
-    Returns the set of csvs with each date_list replaced by a date_indices array,
-    plus the mapping from indices to date strings.'''
+    '''Aligns the timestamps across all CSVs (their sorted union), then assigns indices to
+    them.  Returns the set of csvs with each timestamps array replaced by an array of indices
+    into the union, plus the union.'''
     date_data, gen_data, filenames = zip(*csvs)
-    date_graph = {}
-    for dates in date_data:
-        for dp, dn in zip(dates[:-1], dates[1:]):
-            if dp not in date_graph:
-                date_graph[dp] = set()
-            if dn not in date_graph:
-                date_graph[dn] = set()
-            date_graph[dn].add(dp)
-    ts = graphlib.TopologicalSorter(date_graph)
-    date_sequence = list(ts.static_order())
-    date_idx = {}
-    for date in date_sequence:
-        date_idx[date] = len(date_idx)
+    date_sequence = np.unique(np.concatenate(date_data))
     date_id_data = []
     for dates in date_data:
-        indices = np.array([date_idx[date] for date in dates], dtype=int)
+        indices = np.searchsorted(date_sequence, dates)
         assert np.unique(indices).shape == indices.shape
         date_id_data.append(indices)
     return list(zip(date_id_data, gen_data, filenames)), date_sequence
 
+@traced('combine_aligned_csvs', lambda csvs: {'csvs': len(csvs)})
 def combine_aligned_csvs(csvs):
     '''Merges (sums) a collection of date-aligned csvs into a combined csv'''
     rows = csvs[0][1].shape[0]
@@ -495,15 +2116,85 @@ def combine_aligned_csvs(csvs):
         out[:, idx] += csv
     return out
 
+def region_leaves(region, regions=EIA_REGIONS, within=()):
+    '''The data files (by short name) that make up a region, in order'''
+    if region not in regions:
+        return [region]
+    if region in within:
+        raise Exception(f'Region {region} contains itself')
+    leaves = []
+    for component in regions[region]:
+        component_leaves = region_leaves(component, regions, within + (region,))
+        overlap = [l for l in component_leaves if l in leaves]
+        if overlap:
+            raise Exception(f'Region {region}: {overlap} would be counted twice')
+        leaves += component_leaves
+    return leaves
+
+def eia_region_file(name):
+    '''The data file for a region component (a Region_ file, or a BA file), or None'''
+    for fn in (eia_data_file(f'Region_{name}'), eia_data_file(name)):
+        if os.path.exists(fn):
+            return fn
+    return None
+
+def region_aggregator(loader, key, regions=EIA_REGIONS, leaf_file=eia_region_file, loaded=None):
+    '''Returns aggregate(region), which returns the (dates, data) of a region: the sum of its
+    components.  Leaves (data files) are loaded with loader(leaf_file(name)), unless they are in
+    `loaded` ({fname: (dates, data)}).  Each region is summed once, from the sums of the regions
+    it is made of, and the sums are cached (`key` says how the leaves were loaded).  So a region
+    built from others only costs its own sum, and if it's in the cache, nothing else is loaded.'''
+    loaded = loaded or {}
+    sums = {}
+    def cache_key(name):
+        if name not in regions:
+            return os.path.abspath(leaf_file(name))
+        return (name, [cache_key(c) for c in regions[name]])
+
+    def aggregate(name):
+        if name in sums:
+            return sums[name]
+        if name not in regions:
+            fname = leaf_file(name)
+            sums[name] = loaded[fname] if fname in loaded else loader(fname)[:2]
+        elif len(regions[name]) == 1:
+            sums[name] = aggregate(regions[name][0])
+        else:
+            def load():
+                csvs = [aggregate(c) + (c,) for c in regions[name]]
+                acsvs, dates = align_csv_dates(csvs)
+                return dates, combine_aligned_csvs(acsvs)
+            sources = [leaf_file(l) for l in region_leaves(name, regions)]
+            sums[name] = cached_arrays(re.sub(r'\W', '_', name), (key, cache_key(name), CACHE_FORMAT), sources, load)
+        return sums[name]
+    return aggregate
+
+
+def newest_data_files(dir):
+    '''Lists the CSV and xlsx files in a directory.  Where we have both a CSV and an xlsx
+    with the same name, we use whichever is newer.'''
+    files = {}
+    for i in sorted(os.listdir(dir)):
+        fn = f'{dir}/{i}'
+        stem, ext = os.path.splitext(i)
+        if os.path.isfile(fn) and ext in ('.csv', '.xlsx'):
+            if stem not in files or os.path.getmtime(fn) > os.path.getmtime(f'{dir}/{files[stem]}'):
+                files[stem] = i
+    return sorted(files.values())
+
+def eia_data_file(name):
+    '''The path of the named EIA data file (CSV or xlsx, whichever is newer)'''
+    files = [f for f in newest_data_files(EIA_DATA_DIR) if os.path.splitext(f)[0] == name]
+    return f'{EIA_DATA_DIR}/{files[0] if files else name + ".csv"}'
 
 def load_dir_csvs(dir, filter, loader):
-    '''Load all CSVs from a directory.  Returns a list of triplets:
+    '''Load all CSVs (or xlsx files) from a directory.  Returns a list of triplets:
     (dates, data, filename), one per loaded CSV.
     '''
     csvs = []
-    for i in sorted(os.listdir(dir)):
+    for i in newest_data_files(dir):
         fn = f'{dir}/{i}'
-        if os.path.isfile(fn) and i.endswith('.csv') and filter(i):
+        if filter(i):
             dates, data, _ = loader(fn)
             if len(dates):
                 csvs.append((dates, data, i))
@@ -513,48 +2204,338 @@ def load_dir_csvs(dir, filter, loader):
 def load_all_eia_regions():
     '''Load all the EIA regional data, and construct the aggregate regions'''
     loaded = load_dir_csvs(EIA_DATA_DIR, lambda f: f.find('Region_') >= 0, eia_csv_loader(START_AT_YEAR))
-    shortnames = {fn[fn.find('Region_')+7:-4]: i for i, fn in enumerate(list(zip(*loaded))[2])}
-    for region, components in EIA_REGIONS.items():
-        missing = [f for f in components if f not in shortnames]
+    aggregate = region_aggregator(eia_csv_loader(START_AT_YEAR), ('eia', START_AT_YEAR),
+                                  loaded={f'{EIA_DATA_DIR}/{fn}': (dates, data) for dates, data, fn in loaded})
+    for region in EIA_REGIONS:
+        leaves = region_leaves(region)
+        missing = [f for f in leaves if eia_region_file(f) is None]
         if missing:
             print(f"{region}: missing data for {missing}")
             continue
-        fn = f'{region} ({"+".join(components)})'
-        csvs = [loaded[shortnames[f]] for f in components]
-        acsvs, dates = align_csv_dates(csvs)
-        ccsv = combine_aligned_csvs(acsvs)
+        fn = f'{region} ({"+".join(leaves)})'
+        dates, ccsv = aggregate(region)
         loaded.append((dates, ccsv, fn))
         print(f"{fn} ({ccsv.shape[1]} records)")
     return loaded
 
+def share_array(arr):
+    '''Copies an array into shared memory.  Returns the shared memory block, and a
+    (name, shape, dtype) description that other processes can attach_array() to.'''
+    shm = shared_memory.SharedMemory(create=True, size=max(arr.nbytes, 1))
+    np.ndarray(arr.shape, arr.dtype, buffer=shm.buf)[...] = arr
+    return shm, (shm.name, arr.shape, arr.dtype.str)
+
+def attach_array(desc):
+    '''Returns the shared memory block and array for a share_array() description'''
+    name, shape, dtype = desc
+    shm = shared_memory.SharedMemory(name=name)
+    return shm, np.ndarray(shape, dtype, buffer=shm.buf)
+
+# The datasets available to run_simulation() in worker processes.
+worker_datasets = []
+
+def init_simulation_worker(datasets):
+    '''Attach a worker process to the shared datasets (a list of (dates, desc, fname))'''
+    for dates, desc, fname in datasets:
+        worker_datasets.append((dates, attach_array(desc), fname))
+
+def run_simulation(job):
+    '''Runs a simulation job: (dataset, first slot, label, slots_per_hour, heading).  Returns
+    the output (which is captured, so parallel jobs don't print over the top of each other).'''
+    dataset, start, label, slots_per_hour, heading = job
+    dates, (_, data), _ = worker_datasets[dataset]
+    out = io.StringIO()
+    with contextlib.redirect_stdout(out):
+        print(heading)
+        simulate_cached(data[:, start:], SimParams(label), slots_per_hour, dates[start:])
+    return out.getvalue()
+
+# How many processes to run simulations in.  None means one per CPU, 1 means don't run
+# anything in parallel.
+SIM_PROCESSES = None
+
+def simulate_parallel(datasets, jobs, processes=None):
+    '''Runs simulation jobs in parallel, printing their output in order.  `datasets` is a list
+    of (dates, data, fname), which worker processes share (rather than get copies of).
+    `jobs` is a list of (dataset index, first slot, label, slots_per_hour, heading).'''
+    if processes is None:
+        processes = SIM_PROCESSES
+    if processes == 1:
+        worker_datasets[:] = [(dates, (None, data), fname) for dates, data, fname in datasets]
+        for job in jobs:
+            print(run_simulation(job), end='')
+        return
+    shared = [(dates, share_array(data), fname) for dates, data, fname in datasets]
+    try:
+        with multiprocessing.Pool(processes, init_simulation_worker,
+                                  ([(dates, desc, fname) for dates, (_, desc), fname in shared],)) as pool:
+            # Start the biggest jobs first, so we don't end up waiting for one at the end.
+            order = sorted(range(len(jobs)), key=lambda j: jobs[j][1] - datasets[jobs[j][0]][1].shape[1])
+            results = {}
+            for j in order:
+                results[j] = pool.apply_async(run_simulation, (jobs[j],))
+            for j in range(len(jobs)):
+                print(results[j].get(), end='')
+    finally:
+        for _, (shm, _), _ in shared:
+            shm.close()
+            shm.unlink()
+
+# Monte Carlo runs (see monte_carlo()) resample the weather (and demand) in blocks of this many
+# hours, each taken from within BOOTSTRAP_SEASON_HOURS of its time of year, to keep the seasons.
+BOOTSTRAP_BLOCK_HOURS = 7 * 24
+BOOTSTRAP_SEASON_HOURS = 14 * 24
+MONTE_CARLO_SAMPLES = 1000
+MONTE_CARLO_YEARS = 4
+MONTE_CARLO_SEED = 0
+MONTE_CARLO_QUANTILES = [0.5, 0.9, 0.99]
+# Limits the memory used by each batch of Monte Carlo samples (like SWEEP_BLOCK_BYTES).
+MONTE_CARLO_BATCH_BYTES = 1 << 24
+
+def year_phases(timestamps, slots_per_hour):
+    '''Returns the slot of the (365 day) year each timestamp is in, counting from the first'''
+    seconds = (timestamps - timestamps[0]) / np.timedelta64(1, 's')
+    return np.rint(seconds * slots_per_hour / 3600).astype(np.int64) % (HOURS_PER_YEAR * slots_per_hour)
+
+def bootstrap_sampler(phases, slots_per_hour, block_hours=BOOTSTRAP_BLOCK_HOURS, season_hours=BOOTSTRAP_SEASON_HOURS):
+    '''Returns a function giving the slot indices of synthetic histories, made of blocks of the
+    data which start at the same time of day, within season_hours of the time of year they are
+    used at.  It takes a list of random number generators (one per history) and the number of
+    slots in each history.'''
+    block = block_hours * slots_per_hour
+    season = season_hours * slots_per_hour
+    day_slots = 24 * slots_per_hour
+    year_slots = HOURS_PER_YEAR * slots_per_hour
+    # The year wraps around, so blocks from late December can be used in early January.
+    starts = np.tile(np.arange(len(phases) - block + 1), 3)
+    start_phases = np.concatenate([phases[:len(phases) - block + 1] + y for y in (0, year_slots, 2 * year_slots)])
+    # Sort by the time of day, then the time of year, so each block's candidates are contiguous.
+    key = lambda phase: phase % day_slots * 3 * year_slots + phase
+    order = np.argsort(key(start_phases), kind='stable')
+    starts, start_keys = starts[order], key(start_phases)[order]
+
+    def sample(rngs, slots):
+        targets = np.arange(0, slots, block) % year_slots + year_slots
+        lo = np.searchsorted(start_keys, key(targets) - season)
+        hi = np.maximum(np.searchsorted(start_keys, key(targets) + season, 'right'), lo + 1)
+        picks = lo + (np.array([rng.random(len(targets)) for rng in rngs]) * (hi - lo)).astype(np.int64)
+        picked = starts[np.minimum(picks, len(starts) - 1)]
+        return (picked[..., np.newaxis] + np.arange(block)).reshape(len(rngs), -1)[:, :slots]
+    return sample
+
+# The walk terms and sampler available to monte_carlo_batch() in worker processes.
+worker_bootstrap = []
+
+def init_monte_carlo_worker(desc, phases, slots_per_hour):
+    '''Attach a worker process to the shared walk terms'''
+    worker_bootstrap[:] = [attach_array(desc), bootstrap_sampler(phases, slots_per_hour)]
+
+def monte_carlo_batch(job):
+    '''Evaluates a batch of synthetic histories: (seeds, slots, coefficients of the walk terms,
+    storage slots).  Returns the max drawdown (slots) and the fraction of the time in blackout
+    of each.'''
+    seeds, slots, coefs, storage_slots = job
+    (_, walk_terms), sample = worker_bootstrap
+    terms = walk_terms[:, sample([np.random.default_rng(s) for s in seeds], slots)]
+    walks = np.cumsum(np.tensordot(coefs, terms, 1), axis=1)
+    del terms
+    drawdowns = np.maximum.accumulate(walks, axis=1)
+    drawdowns -= walks
+    max_drawdown = drawdowns.max(axis=1)
+    del drawdowns
+    blackout_fraction = np.zeros(len(seeds))
+    dry = np.flatnonzero(max_drawdown >= storage_slots)
+    row, _, _, ends, depleted = enumerate_drawdowns(walks[dry], storage_slots)
+    blackout_fraction[dry] = np.bincount(row, ends - depleted, len(dry)) / slots
+    return max_drawdown, blackout_fraction
+
+@traced('monte_carlo', lambda basedata, params, *args, **kwargs: {'data': params.filename})
+def monte_carlo(basedata, params, slots_per_hour, timestamps, samples=MONTE_CARLO_SAMPLES,
+                years=MONTE_CARLO_YEARS, seed=MONTE_CARLO_SEED, processes=None, quiet=False):
+    '''Block bootstraps synthetic histories of `years` years from simulate()'s capacity factors
+    and demand (see bootstrap_sampler()), and finds the storage each needs, with the wind
+    fraction and overbuild of the historical simulation.  The samples are run in batches over
+    a process pool (see SIM_PROCESSES), and each has its own seed (spawned from `seed`), so the
+    results don't depend on how they are split up.  Returns arrays of the storage required
+    (storage-hours) and the fraction of the time in blackout (with params.storage_hours).'''
+    if processes is None:
+        processes = SIM_PROCESSES
+    cpfun = simulate(basedata, params, slots_per_hour, timestamps, quiet=True)
+    if cpfun is None:
+        return None
+    walk_terms = cpfun.walk_terms()
+    wind_frac = params.default_wind_fraction
+    if params.optimise_wind_fraction:
+        wind_frac = optimise_wind_frac(walk_parameterised(walk_terms), params.overbuild)
+    coefs = np.array([1 / (1 + params.overbuild), wind_frac, 1 - wind_frac])
+    historical, _, _ = get_max_drawdown(np.cumsum(coefs @ walk_terms))
+    phases = year_phases(cpfun.timestamps, slots_per_hour)
+    slots = years * HOURS_PER_YEAR * slots_per_hour
+    storage_slots = params.storage_hours * slots_per_hour
+    seeds = np.random.SeedSequence(seed).spawn(samples)
+    batch = max(1, MONTE_CARLO_BATCH_BYTES // (8 * 4 * slots))
+    jobs = [(seeds[b:b+batch], slots, coefs, storage_slots) for b in range(0, samples, batch)]
+    if processes == 1:
+        worker_bootstrap[:] = [(None, walk_terms), bootstrap_sampler(phases, slots_per_hour)]
+        results = [monte_carlo_batch(job) for job in jobs]
+    else:
+        shm, desc = share_array(walk_terms)
+        try:
+            with multiprocessing.Pool(processes, init_monte_carlo_worker, (desc, phases, slots_per_hour)) as pool:
+                results = pool.map(monte_carlo_batch, jobs)
+        finally:
+            shm.close()
+            shm.unlink()
+    storage = np.concatenate([r[0] for r in results]) / slots_per_hour
+    blackout_fraction = np.concatenate([r[1] for r in results])
+    if quiet:
+        return storage, blackout_fraction
+
+    params.print_parameters()
+    print(f"Monte Carlo: {samples} synthetic {years}-year histories (seed {seed}), in {BOOTSTRAP_BLOCK_HOURS}-hour blocks "
+          f"from within {BOOTSTRAP_SEASON_HOURS} hours of their time of year")
+    print(f"Wind fraction ({'optimised' if params.optimise_wind_fraction else 'default'}): {wind_frac:.2f}")
+    print(f"Historical storage required (storage-hours): {historical / slots_per_hour:.1f}")
+    print("Storage required to avoid all blackouts (storage-hours), by percentile:")
+    for q, hours in zip(MONTE_CARLO_QUANTILES, np.quantile(storage, MONTE_CARLO_QUANTILES)):
+        print(f"{100 * q:6.1f} {hours:8.1f}")
+    worst = np.argmax(storage)
+    print(f"   max {storage[worst]:8.1f} (sample {worst})")
+    print(f"Histories with blackouts (with {params.storage_hours:.1f} storage-hours): {100 * np.count_nonzero(blackout_fraction) / samples:.1f}%")
+    print(f"Average percentage of time in blackout: {100 * np.average(blackout_fraction):.3f}")
+    return storage, blackout_fraction
+
 def simulate_all_eia_regions():
     loaded = load_all_eia_regions()
-    for dates, data, fname in loaded:
-        print(f'''
+    simulate_parallel(loaded, [(i, 0, fname, 1, f'''
 Data: {fname}
-''')
-        simulate(data, SimParams(fname), 1, dates)
+''') for i, (_, _, fname) in enumerate(loaded)])
 
 def simulate_eia_region(region):
     '''Load and run a specific eia region file'''
-    dates, data, fname = eia_csv_loader(START_AT_YEAR)(f'{EIA_DATA_DIR}/Region_{region}.csv')
-    simulate(data, SimParams(fname), 1, dates)
+    dates, data, fname = eia_csv_loader(START_AT_YEAR)(eia_data_file(f'Region_{region}'))
+    simulate_cached(data, SimParams(fname), 1, dates)
+
+def append_all_eia_regions():
+    '''Bring the simulations of the EIA region files up to date with the hours added to them
+    since the last run (see append_simulation())'''
+    for dates, data, fname in load_dir_csvs(EIA_DATA_DIR, lambda f: f.startswith('Region_'), eia_csv_loader(START_AT_YEAR)):
+        print()
+        append_simulation(data, SimParams(fname), 1, dates)
 
 def simulate_all_eia_files():
     loaded = load_dir_csvs(EIA_DATA_DIR, lambda f: True, eia_csv_loader(START_AT_YEAR))
-    for dates, data, fname in loaded:
-        print(f'''
+    simulate_parallel(loaded, [(i, 0, fname, 1, f'''
 Data: {fname}
-''')
-        simulate(data, SimParams(fname), 1, dates)
+''') for i, (_, _, fname) in enumerate(loaded)])
+
+def sweep_eia_region(region, wind_fractions=np.linspace(0, 1, 11), overbuilds=np.linspace(0, 1, 11)):
+    '''Print the storage required for a region, over a grid of wind fractions and overbuilds'''
+    dates, data, fname = eia_csv_loader(START_AT_YEAR)(eia_data_file(f'Region_{region}'))
+    params = SimParams(fname)
+    cpfun = simulate(data, params, 1, dates, quiet=True)
+    if cpfun is None:
+        return
+    grid = cpfun.sweep(wind_fractions, overbuilds)
+    params.print_parameters()
+    print("Minimum storage required to avoid all blackouts (storage-hours), by wind fraction and overbuild:")
+    print("      " + ''.join(f'{ob:8.2f}' for ob in overbuilds))
+    for wf, row in zip(wind_fractions, grid):
+        print(f"{wf:6.2f}" + ''.join(f'{dd:8.1f}' for dd in row['max_drawdown']))
+    print(f"Percentage of time in blackout (with {params.storage_hours:.1f} storage-hours):")
+    for wf, row in zip(wind_fractions, grid):
+        print(f"{wf:6.2f}" + ''.join(f'{100*bf:8.3f}' for bf in row['blackout_fraction']))
+
+def drawdowns_by_period_eia_regions(kinds=('year', 'season')):
+    '''Print the storage each EIA region would have needed in each calendar period (its biggest
+    drawdown within the period, starting with a full battery), with the wind fraction
+    optimised over all the data'''
+    slots_per_hour = 1
+    for dates, data, fname in load_all_eia_regions():
+        params = SimParams(fname)
+        stages = simulation_stages(data, slots_per_hour, dates)
+        cpfun = simulate(data, params, slots_per_hour, dates, quiet=True, stages=stages)
+        if cpfun is None:
+            continue
+        wind_frac, _ = stages('wind_fraction', params)
+        periods = cpfun.drawdown_index(wind_frac, params.overbuild).periods(cpfun.timestamps, kinds)
+        print(f'\nData: {fname} (wind fraction {wind_frac:.2f})')
+        print('    Period        Storage-hours  Max drawdown')
+        _, labels, drawdowns, starts, ends = zip(*periods)
+        for label, drawdown, start, end in zip(labels, drawdowns, format_timestamps(cpfun.timestamps[list(starts)]).tolist(),
+                                               format_timestamps(cpfun.timestamps[list(ends)]).tolist()):
+            print(f'    {label:13} {drawdown / slots_per_hour:13.1f}  {start} - {end}')
+
+def what_if_eia_region(region, variations):
+    '''Print the main results for a region with each of a list of parameter overrides.  The
+    simulations share their stages, so changing later parameters (like storage_hours or
+    overbuild) doesn't redo the earlier ones.'''
+    dates, data, fname = eia_csv_loader(START_AT_YEAR)(eia_data_file(f'Region_{region}'))
+    stages = simulation_stages(data, 1, dates)
+    SimParams(fname).print_parameters()
+    print("Overrides                                Storage-hours  Wind frac  Blackout %  Curtailed %")
+    for overrides in variations:
+        with contextlib.redirect_stdout(io.StringIO()):
+            cpfun = simulate(data, SimParams(fname, overrides), 1, dates, stages=stages)
+        if cpfun is None:
+            print(f'{str(overrides):40} insufficient renewables datapoints')
+            continue
+        r = cpfun.results
+        print(f"{str(overrides):40} {r['storage_required']:13.1f} {r['wind_fraction']:10.2f} "
+              f"{r['blackout_percent']:11.3f} {r['curtailed_percent']:12.1f}")
+
+def plan_eia_region(region, storage_hour_cost, storage_hours=None):
+    '''Print the smallest overbuild which avoids all blackouts with storage_hours of storage
+    (by default, the simulation's), and the cheapest overbuild and storage, given the cost of a
+    storage-hour (as a fraction of the cost of the base renewables build).'''
+    dates, data, fname = eia_csv_loader(START_AT_YEAR)(eia_data_file(f'Region_{region}'))
+    params = SimParams(fname)
+    cpfun = simulate(data, params, 1, dates, quiet=True)
+    if cpfun is None:
+        return
+    if storage_hours is None:
+        storage_hours = params.storage_hours
+    solver = cpfun.solver()
+    params.print_parameters()
+    plan = solver.min_overbuild(storage_hours)
+    if plan is None:
+        print(f"No overbuild (up to 1000%) avoids all blackouts with {storage_hours:.1f} storage-hours")
+    else:
+        print(f"Minimum overbuild for {storage_hours:.1f} storage-hours: {plan[0]:.3f} (wind fraction: {plan[1]:.2f}, storage-hours needed: {plan[2]:.1f})")
+    overbuild, wind_frac, storage = solver.cheapest(storage_hour_cost)
+    print(f"Cheapest with a storage-hour costing {storage_hour_cost}: overbuild {overbuild:.3f}, {storage:.1f} storage-hours (wind fraction: {wind_frac:.2f})")
+
+def monte_carlo_eia_region(region, samples=MONTE_CARLO_SAMPLES, seed=MONTE_CARLO_SEED):
+    '''Print the distribution of the storage a region needs, over resampled weather'''
+    dates, data, fname = eia_csv_loader(START_AT_YEAR)(eia_data_file(f'Region_{region}'))
+    monte_carlo(data, SimParams(fname), 1, dates, samples, seed=seed)
+
+# Tesla's four regions (see tsla-grid.md).
+TESLA_REGIONS = ['Western', 'Central', 'Texas', 'Eastern']
+
+def simulate_interconnected_eia_regions(members=TESLA_REGIONS, link_capacity=INTERCONNECT_CAPACITY):
+    '''Simulate EIA regions (from EIA_REGIONS, or data files) as separate regions, linked by
+    interconnects'''
+    missing = [l for m in members for l in region_leaves(m) if eia_region_file(l) is None]
+    if missing:
+        print(f"Missing data for {missing}")
+        return
+    aggregate = region_aggregator(eia_csv_loader(START_AT_YEAR), ('eia', START_AT_YEAR))
+    csvs = [aggregate(m) + (m,) for m in members]
+    simulate_interconnected(csvs, SimParams(' + '.join(members)), 1, link_capacity)
 
 # To look at how the numbers are affected by data (and startup) artifacts.
 def eia_csv_by_month(file):
     '''Simulate an EIA data file multiple times, starting at different dates'''
-    dates, data, fname = eia_csv_loader(None)(f'{EIA_DATA_DIR}/{file}.csv')
-    for i in range(0, len(dates) - 365*24, 30*24):
-        print(f"{file} (from {dates[i]})")
-        simulate(data[:,i:], SimParams(f'{fname}: from {dates[i]}'), 1, dates[i:])
+    dates, data, fname = eia_csv_loader(None)(eia_data_file(file))
+    simulate_parallel([(dates, data, fname)], [
+        (0, i, f'{fname}: from {format_timestamp(dates[i])}', 1, f"{file} (from {format_timestamp(dates[i])})")
+        for i in range(0, len(dates) - 365*24, 30*24)])
+
+def eia_start_date_scan(file):
+    '''Print the storage an EIA data file needs, starting at monthly intervals'''
+    dates, data, fname = eia_csv_loader(None)(eia_data_file(file))
+    start_date_scan(data, SimParams(fname), 1, dates, 30*24)
 
 # There is bad data in the gridwatch csv before Feb 2018 which completely screws things (you
 # can include Jan 2018 if you delete the line containing the -6e34 interchange value:
@@ -564,37 +2545,232 @@ def simulate_gridwatch_csv():
     '''Run the simulator over the 2018-now data'''
     fname = f'gridwatch-data/gridwatch-2018-on.csv'
     if os.path.exists(fname):
-        dates, data, fname = gridwatch_csv_loader(START_AT_YEAR)(fname)
-        simulate(data, SimParams(fname), 12, dates)
+        dates, data, fname = gridwatch_csv_loader(START_AT_YEAR, GRIDWATCH_SLOTS_PER_HOUR)(fname)
+        simulate_cached(data, SimParams(fname), GRIDWATCH_SLOTS_PER_HOUR or 12, dates)
     else:
         print(f"No GridWatch data ({fname})")
 
 # Figure out how much historical gridwatch data is somewhat usable.
 def gridwatch_csv_by_month():
     '''Simulate the 2011-now gridwatch data multiple times, starting at different dates'''
-    dates, data, fname = gridwatch_csv_loader(None)(f'gridwatch-data/gridwatch-2011-on.csv')
-    for i in range(0, len(dates) - 365*24*12, 30*24*12):
-        print(f"Gridwatch (from {dates[i]})")
-        simulate(data[:,i:], SimParams(f'{fname}: from {dates[i]}'), 12, dates[i:])
-
-# simulate_eia_region('US48')
-# simulate_eia_region('TEX')
-# simulate_eia_region('CAL')
-# simulate_eia_region('NW')
-# simulate_eia_region('CENT')
-
-simulate_all_eia_regions()
-simulate_gridwatch_csv()
-
-# To work out where the data anomalies end in a file
-# gridwatch_csv_by_month()
-# eia_csv_by_month('Region_TEX')
-# eia_csv_by_month('Region_US48')
-# eia_csv_by_month('Region_CENT')
-# eia_csv_by_month('Region_MIDA')
-# eia_csv_by_month('BPAT')
-# eia_csv_by_month('GRID')
-# eia_csv_by_month('NWMT')
-
-# Simulate the individual BA files as well as regions.
-# simulate_all_eia_files()
+    dates, data, fname = gridwatch_csv_loader(None, GRIDWATCH_SLOTS_PER_HOUR)(f'gridwatch-data/gridwatch-2011-on.csv')
+    slots_per_hour = GRIDWATCH_SLOTS_PER_HOUR or 12
+    simulate_parallel([(dates, data, fname)], [
+        (0, i, f'{fname}: from {format_timestamp(dates[i])}', slots_per_hour, f"Gridwatch (from {format_timestamp(dates[i])})")
+        for i in range(0, len(dates) - 365*24*slots_per_hour, 30*24*slots_per_hour)])
+
+def gridwatch_start_date_scan():
+    '''Print the storage the 2011-now gridwatch data needs, starting at monthly intervals'''
+    dates, data, fname = gridwatch_csv_loader(None, GRIDWATCH_SLOTS_PER_HOUR)(f'gridwatch-data/gridwatch-2011-on.csv')
+    slots_per_hour = GRIDWATCH_SLOTS_PER_HOUR or 12
+    start_date_scan(data, SimParams(fname), slots_per_hour, dates, 30*24*slots_per_hour)
+
+# A long-lived server (python3 tsla-grid-sim.py --serve), which loads the data once, and runs
+# simulations for its clients (python3 tsla-grid-sim.py --query TEX '{"storage_hours": 30}').
+# Requests and responses are lines of JSON, over a Unix socket (see serve_queries()).
+SERVER_SOCKET = 'tsla-grid-sim.sock'
+
+def server_datasets():
+    '''The datasets a server loads: the EIA regions (and the aggregate regions), and the
+    GridWatch data if it's there.  Returns a list of (dates, data, fname, slots_per_hour).'''
+    datasets = [(dates, data, fname, 1) for dates, data, fname in load_all_eia_regions()]
+    fname = 'gridwatch-data/gridwatch-2018-on.csv'
+    if os.path.exists(fname):
+        datasets.append(gridwatch_csv_loader(START_AT_YEAR, GRIDWATCH_SLOTS_PER_HOUR)(fname) + (GRIDWATCH_SLOTS_PER_HOUR or 12,))
+    return datasets
+
+def dataset_names(fname):
+    '''The names a dataset can be asked for by: its file name ('Region_TEX.csv' or
+    'gridwatch-data/gridwatch-2018-on.csv'), an aggregate region's name ('Texas'), or the
+    region ('TEX', or 'gridwatch')'''
+    base = os.path.basename(fname).split(' (')[0]
+    return [fname, base, re.sub(r'^Region_|\.csv$', '', base), base.split('-')[0]]
+
+# The simulation stages of each dataset in a server's worker processes (see
+# simulation_stages()), so the queries on a dataset share the stages they have in common.
+worker_stages = {}
+
+def run_query(job):
+    '''Runs a server query: (dataset, slots_per_hour, parameter overrides).  Returns (results,
+    report), where results are simulate()'s (None if there wasn't enough data) and the report
+    is what it printed.'''
+    dataset, slots_per_hour, overrides = job
+    dates, (_, data), fname = worker_datasets[dataset]
+    if dataset not in worker_stages:
+        worker_stages[dataset] = simulation_stages(data, slots_per_hour, dates)
+    out = io.StringIO()
+    with contextlib.redirect_stdout(out):
+        cpfun = simulate(data, SimParams(fname, overrides), slots_per_hour, dates, stages=worker_stages[dataset])
+    return cpfun.results if cpfun else None, out.getvalue()
+
+async def serve_queries(socket_path, pool, datasets):
+    '''Answers queries on a Unix socket, running the simulations in pool (whose workers have
+    the datasets, a list of (fname, slots_per_hour)).  Each line a client sends is a JSON
+    request, and gets a line of JSON back:
+
+    {"dataset": "TEX", "overrides": {"storage_hours": 30}}
+        -> {"dataset": fname, "results": simulate()'s results, "report": what it printed}
+    {"datasets": true}
+        -> {"datasets": [fname, ...]}
+
+    or {"error": message}.  A client's requests are answered in turn, and different clients'
+    at the same time (as many as the pool has workers).'''
+    loop = asyncio.get_running_loop()
+    names = {}
+    for i, (fname, _) in enumerate(datasets):
+        for name in dataset_names(fname):
+            names.setdefault(name, i)
+
+    def run(job):
+        future = loop.create_future()
+        pool.apply_async(run_query, (job,), callback=lambda r: loop.call_soon_threadsafe(future.set_result, r),
+                         error_callback=lambda e: loop.call_soon_threadsafe(future.set_exception, e))
+        return future
+
+    async def answer(request):
+        if request.get('datasets'):
+            return {'datasets': [fname for fname, _ in datasets]}
+        if request.get('dataset') not in names:
+            return {'error': f"Unknown dataset: {request.get('dataset')}"}
+        dataset = names[request['dataset']]
+        fname, slots_per_hour = datasets[dataset]
+        overrides = request.get('overrides') or {}
+        # Check the parameters before we queue the job (only the simulation parameters, not
+        # everything SimParams.set_parameters() would let through, like its methods).
+        unknown = [k for k in overrides if k not in SimParams(fname).parameter_defaults()]
+        if unknown:
+            raise Exception(f'Unknown parameters: {", ".join(unknown)}')
+        SimParams(fname, overrides)
+        results, report = await run((dataset, slots_per_hour, overrides))
+        return {'dataset': fname, 'results': results, 'report': report}
+
+    async def client(reader, writer):
+        try:
+            while line := await reader.readline():
+                try:
+                    response = await answer(json.loads(line))
+                except Exception as e:
+                    response = {'error': str(e)}
+                writer.write(json.dumps(response).encode() + b'\n')
+                await writer.drain()
+        finally:
+            writer.close()
+
+    server = await asyncio.start_unix_server(client, socket_path)
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, server.close)
+    print(f'Serving {len(datasets)} datasets on {socket_path}')
+    async with server:
+        try:
+            await server.serve_forever()
+        except asyncio.CancelledError:
+            pass # closed by a signal
+
+def init_server_worker(datasets):
+    '''init_simulation_worker() for a server's pool: Ctrl-C interrupts the whole process group,
+    and only the server should act on it (it closes the pool on the way out).'''
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    init_simulation_worker(datasets)
+
+def remove_stale_socket(socket_path):
+    '''Removes a socket left behind by a server which didn't shut down, but stops if there's a
+    server still answering on it.'''
+    with socket.socket(socket.AF_UNIX) as s:
+        try:
+            s.connect(socket_path)
+        except (ConnectionRefusedError, FileNotFoundError):
+            if os.path.exists(socket_path):
+                os.unlink(socket_path)
+            return
+    raise Exception(f'Server already running on {socket_path}')
+
+def serve(socket_path=SERVER_SOCKET, processes=None):
+    '''Loads the server_datasets() into shared memory, and answers queries (see serve_queries())
+    until interrupted.  The worker processes attach to the shared data rather than copying it.'''
+    if processes is None:
+        processes = SIM_PROCESSES
+    remove_stale_socket(socket_path)
+    shared = [(dates, share_array(data), fname, slots_per_hour) for dates, data, fname, slots_per_hour in server_datasets()]
+    try:
+        with multiprocessing.Pool(processes, init_server_worker,
+                                  ([(dates, desc, fname) for dates, (_, desc), fname, _ in shared],)) as pool:
+            asyncio.run(serve_queries(socket_path, pool, [(fname, slots_per_hour) for _, _, fname, slots_per_hour in shared]))
+    finally:
+        for _, (shm, _), _, _ in shared:
+            shm.close()
+            shm.unlink()
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+
+def query_server(request, socket_path=SERVER_SOCKET):
+    '''Sends a request to a server (see serve_queries()), and returns its response'''
+    with socket.socket(socket.AF_UNIX) as s:
+        s.connect(socket_path)
+        s.sendall(json.dumps(request).encode() + b'\n')
+        with s.makefile() as f:
+            return json.loads(f.readline())
+
+if __name__ == '__main__':
+    # Extract downloaded EIA workbooks (see download-eia-data.sh).
+    if sys.argv[1:2] == ['--extract']:
+        extract_all_eia_xlsx()
+        sys.exit()
+    # Update the region simulations with new data (only the new rows are parsed, if the CSVs
+    # have just had rows added, and only the affected part of each simulation is recalculated).
+    if sys.argv[1:2] == ['--append']:
+        append_all_eia_regions()
+        sys.exit()
+    # Keep the data loaded, and run simulations for --query (e.g. --query TEX '{"overbuild": 0.5}').
+    if sys.argv[1:2] == ['--serve']:
+        serve()
+        sys.exit()
+    if sys.argv[1:2] == ['--query']:
+        response = query_server({'dataset': sys.argv[2], 'overrides': json.loads(sys.argv[3]) if sys.argv[3:] else {}})
+        print(response.get('report') or response.get('error') or response)
+        sys.exit()
+
+    # simulate_eia_region('US48')
+    # simulate_eia_region('TEX')
+    # simulate_eia_region('CAL')
+    # simulate_eia_region('NW')
+    # simulate_eia_region('CENT')
+
+    simulate_all_eia_regions()
+    simulate_gridwatch_csv()
+
+    # To work out where the data anomalies end in a file
+    # gridwatch_csv_by_month()
+    # eia_csv_by_month('Region_TEX')
+    # eia_csv_by_month('Region_US48')
+    # eia_csv_by_month('Region_CENT')
+    # eia_csv_by_month('Region_MIDA')
+    # eia_csv_by_month('BPAT')
+    # eia_csv_by_month('GRID')
+    # eia_csv_by_month('NWMT')
+    # Or, much faster (but only showing the storage required):
+    # gridwatch_start_date_scan()
+    # eia_start_date_scan('Region_TEX')
+
+    # Simulate the individual BA files as well as regions.
+    # simulate_all_eia_files()
+
+    # Storage requirements over a grid of wind fractions and overbuilds.
+    # sweep_eia_region('TEX')
+
+    # The storage each region needed in each year and season.
+    # drawdowns_by_period_eia_regions()
+
+    # What if we had more storage, or more overbuild?  (Only the late stages are rerun.)
+    # what_if_eia_region('TEX', [{'storage_hours': h} for h in (10, 30, 90)] + [{'overbuild': ob} for ob in (0, 0.5, 1)])
+
+    # The smallest overbuild for the storage we have, and the cheapest overbuild and storage
+    # (if a storage-hour costs 1% of the base renewables build).
+    # plan_eia_region('TEX', 0.01)
+
+    # The storage needed for 99% of 1000 resampled 4-year histories (rather than the one we had).
+    # monte_carlo_eia_region('TEX')
+
+    # Tesla's four regions, with a battery in each and limited interconnects between them.
+    # simulate_interconnected_eia_regions()
+    # Or all the regions, with today's (roughly 1%) interconnects.
+    # simulate_interconnected_eia_regions(EIA_REGIONS['Western'] + EIA_REGIONS['Central'] + EIA_REGIONS['Texas'] + EIA_REGIONS['Eastern'], 0.01)